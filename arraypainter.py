@@ -0,0 +1,254 @@
+from panda3d.core import Filename, PNMImage, Shader, Texture, TexturePool
+from helper import LRUCache
+from paintcanvas import BrushRect, StampPoints, CanvasDirty
+import numpy as np
+import math
+
+
+def Sample(image, u, v):
+    """ Returns the pixels of an image (float array [y][x][channels], bottom row first) at u, v
+    (arrays, 0-1 over the image) with linear filtering, clamped to the edges, like a texture """
+    height, width = image.shape[:2]
+    x = np.clip(u * width - 0.5, 0.0, width - 1.0).ravel()
+    y = np.clip(v * height - 0.5, 0.0, height - 1.0).ravel()
+    x0, y0 = x.astype(np.int32), y.astype(np.int32)
+    fx, fy = (x - x0)[:, None], (y - y0)[:, None]
+    dx = (x0 < width - 1).astype(np.int32)
+    dy = (y0 < height - 1).astype(np.int32) * width
+    # the four texels as rows of the flat image
+    texels = image.reshape(width * height, -1)
+    i = y0 * width + x0
+    bottom = texels.take(i, axis=0)
+    bottom += (texels.take(i + dx, axis=0) - bottom) * fx
+    top = texels.take(i + dy, axis=0)
+    top += (texels.take(i + dy + dx, axis=0) - top) * fx
+    bottom += (top - bottom) * fy
+    return bottom.reshape(u.shape + image.shape[2:])
+
+
+def BoxBlur(canvas, rect):
+    """ Returns the mean of each pixel of a canvas (array [y][x][channels]) in rect (x0, y0, x1, y1)
+    and of its 8 neighbors, as floats, the pixels past the edges are those on the edge """
+    x0, y0, x1, y1 = rect
+    height, width = canvas.shape[:2]
+    ys = np.clip(np.arange(y0 - 1, y1 + 1), 0, height - 1)
+    xs = np.clip(np.arange(x0 - 1, x1 + 1), 0, width - 1)
+    area = canvas[ys[:, None], xs[None, :]].astype(np.float32)
+    rows = area[:-2] + area[1:-1] + area[2:]
+    return (rows[:, :-2] + rows[:, 1:-1] + rows[:, 2:]) * np.float32(1.0 / 9.0)
+
+
+def LoadRGBA(file, size=None):
+    """ Returns an image file as a uint8 array [y][x][rgba], bottom row first (like a texture),
+    stretched to size x size if a size is given (like a texture on the canvas plane) """
+    texture = TexturePool.loadTexture(Filename(file))
+    data = np.frombuffer(texture.getRamImageAs('RGBA'), dtype=np.uint8)
+    data = data.reshape(texture.getYSize(), texture.getXSize(), 4)
+    if size is not None and data.shape[:2] != (size, size):
+        uv = (np.arange(size, dtype=np.float32) + 0.5) / size
+        u, v = np.meshgrid(uv, uv)
+        return np.rint(Sample(data.astype(np.float32), u, v)).astype(np.uint8)
+    return data.copy()
+
+
+# the brush shaders of the editor (by the file of the fragment shader) and the ArrayPainter method doing the same
+BRUSH_SHADERS = {'brush_f.glsl': '_blendHeight', 'brush3_f.glsl': '_blendWalk'}
+
+
+class ArrayPainter(CanvasDirty):
+    """
+    Paints the same canvases as BufferPainter, but on the CPU, each canvas is a numpy array.
+    There is no window, no pointer and no mouse: setPos() puts the brush, paint(id) stamps it
+    (blended like the brush card: brush texture * brush color, over the canvas by its alpha),
+    paintStroke() stamps it along a line. Brush shaders can't be run, the ones of the editor
+    are done in numpy instead (see BRUSH_SHADERS), with the inputs set by setShaderInput().
+    """
+
+    def __init__(self, brushList, stamp_spacing=0.25, cache_size=256):
+        self.brushList = brushList
+        self.stamp_spacing = stamp_spacing
+        self.stamps = LRUCache(cache_size)  # the last brushes drawn, see _stamp()
+        self.canvases = []  # uint8 [y][x][rgba], y from the bottom (the world y)
+        self.buffSize = []
+        self.dirty = []  # for each canvas {consumer: [x0, y0, x1, y1]} changed pixels
+        self.colors = []  # brush color of each canvas
+        self.blends = []  # for each canvas the method blending the brush, see BRUSH_SHADERS
+        self.shader_inputs = []  # for each canvas {name: value}, like the inputs of its brush shader
+        self.brushSize = 1.0
+        self.brushAlpha = 0.05
+        self.heading = 0.0
+        self.pos = (256.0, 256.0)
+        self.setBrushTex(0)
+
+    def addCanvas(self, size=512, default_tex='data/black.png', brush_shader=None, shader_inputs=None):
+        """ Adds a canvas, brush_shader is a Shader or the file of its fragment shader,
+        only those in BRUSH_SHADERS can be used """
+        blend = self._blend
+        if brush_shader:
+            if isinstance(brush_shader, Shader):
+                brush_shader = brush_shader.getFilename(Shader.ST_fragment)
+            name = Filename(brush_shader).getBasename()
+            if name not in BRUSH_SHADERS:
+                raise NotImplementedError("ArrayPainter has no numpy version of the brush shader " + name)
+            blend = getattr(self, BRUSH_SHADERS[name])
+        self.buffSize.append(size)
+        self.dirty.append({})
+        self.canvases.append(LoadRGBA(default_tex, size))
+        self.colors.append([1.0, 1.0, 1.0, 0.05])
+        self.blends.append(blend)
+        self.shader_inputs.append(dict(shader_inputs or {}))
+
+    def setShaderInput(self, id, name, value):
+        """ Sets an input of the brush shader of canvas id, like brushes[id].setShaderInput() of a BufferPainter """
+        self.shader_inputs[id][name] = value
+
+    def loadCanvas(self, id, file):
+        """ Replaces the content of canvas id with an image file """
+        self.canvases[id] = LoadRGBA(file, self.buffSize[id])
+        self.markDirty(id)
+
+    def readCanvas(self, id):
+        """ Returns a Texture with the ram image of canvas id, like BufferPainter.readCanvas() """
+        texture = Texture()
+        texture.setup2dTexture(self.buffSize[id], self.buffSize[id], Texture.TUnsignedByte, Texture.FRgba8)
+        texture.setRamImageAs(self.canvases[id].tobytes(), 'RGBA')
+        return texture
+
+    def write(self, id, file, returnPNMImage=False):
+        p = PNMImage()
+        self.readCanvas(id).store(p)
+        p.removeAlpha()
+        p.write(file)
+        if returnPNMImage:
+            return p
+
+    def brushRect(self, id, pos=None):
+        """ Returns the pixels of canvas id under the brush (x0, y0, x1, y1) """
+        if pos is None:
+            pos = self.pos
+        return BrushRect(pos, self.heading, self.brushSize, self.buffSize[id])
+
+    def setPos(self, x, y):
+        """ Puts the brush at x, y (world units, the canvases cover 0-512) """
+        self.pos = (min(512.0, max(0.0, x)), min(512.0, max(0.0, y)))
+
+    def _stamp(self, id):
+        """ Returns the brush of canvas id where it is now: its first pixel (x, y), the color times the alpha
+        and 1 - alpha of its pixels (not clipped to the canvas). The brushes are kept for the same size,
+        heading, color and place in the first pixel (to 1/256 of a pixel, what the gpu can tell apart too) """
+        scale = self.buffSize[id] / 512.0
+        heading = math.radians(self.heading)
+        x, y = self.pos
+        x0, y0, x1, y1 = BrushRect(self.pos, self.heading, self.brushSize, self.buffSize[id], clip=False)
+        width, height = x1 - x0, y1 - y0
+        fx, fy = round((x * scale - x0) * 256.0) / 256.0, round((y * scale - y0) * 256.0) / 256.0
+        key = (self.brush_id, self.brushSize, self.heading, tuple(self.colors[id]), scale, fx, fy, width, height)
+        stamp = self.stamps.get(key)
+        if stamp is None:
+            # the pixel centers in the card space, -16...16 over the brush
+            x, y = np.meshgrid((np.arange(width, dtype=np.float32) + 0.5 - fx) / scale,
+                               (np.arange(height, dtype=np.float32) + 0.5 - fy) / scale)
+            cos, sin = math.cos(heading) / self.brushSize, math.sin(heading) / self.brushSize
+            u = (x * cos + y * sin) / 32.0 + 0.5
+            v = (y * cos - x * sin) / 32.0 + 0.5
+            src = Sample(self.brush_image, u, v) * np.array(self.colors[id], dtype=np.float32)
+            # nothing outside of the card
+            src[(u < 0.0) | (u > 1.0) | (v < 0.0) | (v > 1.0)] = 0.0
+            alpha = src[..., 3:]
+            stamp = (src * alpha * np.float32(255.0), np.float32(1.0) - alpha)
+            self.stamps.put(key, stamp)
+        return x0, y0, stamp
+
+    def paint(self, id):
+        """ Stamps the brush on canvas id """
+        x0, y0, x1, y1 = rect = self.brushRect(id)
+        if x1 <= x0 or y1 <= y0:
+            return
+        self.markDirty(id, rect)
+        x, y, (color, keep) = self._stamp(id)
+        color, keep = color[y0 - y:y1 - y, x0 - x:x1 - x], keep[y0 - y:y1 - y, x0 - x:x1 - x]
+        self.blends[id](id, rect, color, keep)
+
+    def _blend(self, id, rect, color, keep):
+        """ Blends a stamp (see _stamp()) over the pixels of canvas id in rect, like the brush card """
+        x0, y0, x1, y1 = rect
+        canvas = self.canvases[id][y0:y1, x0:x1]
+        # the canvas is 8 bits, like the buffer, so each stamp is rounded
+        canvas[...] = np.rint(canvas * keep + color)
+
+    def _blendHeight(self, id, rect, color, keep):
+        """ The height brush: up, down and level blend the brush color (white, black or the level)
+        like the brush card, with use_map the brush blurs the canvas (the mean of 3x3 pixels) by its alpha """
+        if not self.shader_inputs[id].get('use_map', 0.0):
+            self._blend(id, rect, color, keep)
+            return
+        x0, y0, x1, y1 = rect
+        # all of it from the canvas before the stamp, the gpu reads the last copy of the canvas
+        blurred = BoxBlur(self.canvases[id], rect)
+        canvas = self.canvases[id][y0:y1, x0:x1]
+        canvas[...] = np.rint(canvas * keep + blurred * (np.float32(1.0) - keep))
+
+    def _blendWalk(self, id, rect, color, keep):
+        """ The walkmap brush: the brush color where the brush is more than half opaque, a cell of the walkmap
+        is walkable or not, there is nothing in between """
+        x0, y0, x1, y1 = rect
+        canvas = self.canvases[id][y0:y1, x0:x1]
+        canvas[keep[..., 0] < 0.5] = np.rint(np.array(self.colors[id], dtype=np.float32) * np.float32(255.0))
+
+    def paintStroke(self, id, points):
+        """ Stamps the brush on canvas id at each of the points (x, y) and every stamp_spacing
+        brush sizes between them, then leaves the brush at the last point """
+        last = None
+        for point in points:
+            if last is not None:
+                for x, y in StampPoints(last[:2], point[:2], self.brushSize, self.stamp_spacing).tolist():
+                    self.setPos(x, y)
+                    self.paint(id)
+            self.setPos(point[0], point[1])
+            self.paint(id)
+            last = point
+
+    def setBrushIDColor(self, id, color, keep_alpha=True):
+        if keep_alpha:
+            alpha = self.colors[id][3]
+        else:
+            alpha = color[3]
+        self.colors[id] = [color[0], color[1], color[2], alpha]
+
+    def setBrushIDAlpha(self, id, new_alpha):
+        self.colors[id][3] = new_alpha
+
+    def setBrushAlpha(self, slider=None, alpha=None):
+        if slider:
+            alpha = slider['value']
+        new_alpha = min(1.0, max(0.0, alpha))
+        self.brushAlpha = new_alpha
+        for color in self.colors:
+            color[3] = new_alpha
+
+    def adjustBrushAlpha(self, alpha):
+        self.setBrushAlpha(alpha=self.brushAlpha + alpha)
+
+    def setBrushColor(self, color):
+        for id in range(len(self.colors)):
+            self.setBrushIDColor(id, color)
+
+    def setBrushTex(self, id):
+        self.brush_id = id
+        self.brush_image = LoadRGBA(self.brushList[id]).astype(np.float32) * np.float32(1.0 / 255.0)
+
+    def setBrushHeading(self, slider=None, heading=None):
+        if slider:
+            heading = int(slider['value'])
+        self.heading = heading % 360.0
+
+    def adjustBrushHeading(self, heading):
+        self.heading = (self.heading + heading) % 360.0
+
+    def setBrushSize(self, slider=None, size=None):
+        if slider:
+            size = slider['value']
+        self.brushSize = min(10.00, max(0.01, size))
+
+    def adjustBrushSize(self, size):
+        self.setBrushSize(size=self.brushSize + size)
@@ -1,14 +1,38 @@
 from panda3d.core import *
+from heightpicker import HeightPicker
+from painthistory import PaintHistory, GetTiles, TileRect, PackTile, UnpackTile
+from paintcanvas import BrushRect, StampPoints, CanvasDirty
+import numpy as np
 
 
-class BufferPainter:
+def _NoProgress(fraction):
+    pass
+
+
+def WriteImage(texture, file, progress=None):
+    """ Writes a Texture with a ram image to a file (without the alpha) and returns it as a PNMImage,
+    can run on a worker thread (see BackgroundJob) with a copy of the texture """
+    if progress is None:
+        progress = _NoProgress
+    p = PNMImage(texture.getXSize(), texture.getYSize(), 4)
+    texture.store(p)
+    p.removeAlpha()
+    progress(0.5)
+    p.write(file)
+    progress(1.0)
+    return p
+
+
+class BufferPainter(CanvasDirty):
     """
     class responsible for pointer and see where the mouse is.
     """
 
-    def __init__(self, brushList, showBuff=False):
+    def __init__(self, brushList, showBuff=False, undo_memory=64, stamp_spacing=0.25):
         self.use_gl_select = False
         self.pixel = VBase4()  # used by gl picking
+        self.height_picker = None  # used by height picking
+        self.height_picker_id = None
         self.brushList = brushList
 
         # make a pointer
@@ -28,13 +52,31 @@ class BufferPainter:
         self.buffers = []
         self.brushes = []
         self.textures = []
+        self.copies = []  # the last painted state of each canvas, what the canvas draws over
+        self.regions = []  # inactive display regions, for reading back a part of a canvas
+        self.images = []  # the canvas as last read back, a Texture with a ram image
         self.roots = []
         self.cameras = []
         self.paintPlanes = []
         self.buffSize = []
+        self.dirty = []  # for each canvas {consumer: [x0, y0, x1, y1]} changed pixels
         self.brushSize = 1.0
         self.brushAlpha = 0.05
         self.hiddenBrushes = []
+        self.lastPointerPos = Point3(self.pointer.getPos())
+        self.painted = set()  # canvases copied this frame
+        self.synced = set()  # canvases read back (without the brush) after this frame
+        self.hidden = set()  # canvases drawn without the brush this frame
+        self.unhide = set()  # brushes hidden for this frame only
+        self.read_callbacks = []  # [(ids, callback)] called after this frame
+        self.tile_cards = []  # tiles put back by undo/redo, drawn for one frame
+        self.stroke = {}  # for each canvas painted on now {tile: packed tile from before the stroke}
+        self.stroke_ended = False  # endStroke() was called, the stroke is read back and pushed after the next frame
+        self.starts = {}  # for each canvas the first stamp of a stroke, waiting for the ram copy to be read back
+        self.last_stamp = {}  # for each canvas painted on now, where the brush was the last time
+        self.stamp_spacing = stamp_spacing  # fraction of the brush size between the stamps of a fast stroke
+        self.stamp_nodes = []  # stamps between the last and current brush position, drawn for one frame
+        self.history = PaintHistory(undo_memory * 2 ** 20)
 
         # view the buffers
         if showBuff:
@@ -43,6 +85,20 @@ class BufferPainter:
             base.bufferViewer.setCardSize(0.2, 0.0)
 
         taskMgr.add(self.__getMousePos, "_Editor__getMousePos")
+        # right before and after the frame is rendered (igLoop is 50, the editor paints at 46)
+        taskMgr.add(self.__beforeRender, "_Editor__beforeRender", sort=48)
+        taskMgr.add(self.__afterRender, "_Editor__afterRender", sort=55)
+
+    def setupHeightPicking(self, id, scale=100.0):
+        """ Puts the pointer where the mouse ray hits the terrain made from the heights on canvas id,
+        (see HeightPicker) instead of on a flat plane """
+        self.height_picker = HeightPicker(scale=scale)
+        self.height_picker_id = id
+
+    def setPickingScale(self, scale):
+        """ Sets the z_scale of the terrain for height picking """
+        if self.height_picker:
+            self.height_picker.scale = scale
 
     # useless
     def setup_gl_select(self, height, scale=100.0):
@@ -86,21 +142,25 @@ class BufferPainter:
 
     # used with saving/exporting
     def write(self, id, file, returnPNMImage=False):
-        p = PNMImage(self.buffSize[id], self.buffSize[id], 4)
-        base.graphicsEngine.extractTextureData(self.textures[id], base.win.getGsg())
-        self.textures[id].store(p)
-        p.removeAlpha()
-        p.write(file)
+        p = WriteImage(self.readCanvas(id), file)
         if returnPNMImage:
             return p
 
     def addCanvas(self, size=512, default_tex='data/black.png', brush_shader=None, shader_inputs=None):
         id = str(len(self.buffers))
         self.buffSize.append(size)
+        self.dirty.append({})
         self.roots.append(NodePath("bufferRender" + id))
         self.textures.append(Texture())
         self.buffers.append(base.win.makeTextureBuffer("canvas" + id, size, size, self.textures[-1]))
         self.buffers[-1].setSort(-100)
+        # painting copies the buffer to this texture on the gpu, no need to read it back
+        self.copies.append(Texture("canvas_copy" + id))
+        self.copies[-1].setup2dTexture(size, size, Texture.TUnsignedByte, Texture.FRgba8)
+        self.buffers[-1].addRenderTexture(self.copies[-1], GraphicsOutput.RTMTriggeredCopyTexture)
+        self.regions.append(self.buffers[-1].makeDisplayRegion())
+        self.regions[-1].setActive(False)
+        self.images.append(None)
         # the camera for the buffer
         self.cameras.append(base.makeCamera(win=self.buffers[-1]))
         self.cameras[-1].reparentTo(self.roots[-1])
@@ -123,6 +183,8 @@ class BufferPainter:
         self.brushes[-1].lookAt(0, 0, -1)
         self.brushes[-1].setTexture(loader.loadTexture(self.brushList[0]))
         self.brushes[-1].setTransparency(TransparencyAttrib.MAlpha)
+        # after the stamps that fill the gap up to it, see __drawStamps()
+        self.brushes[-1].setBin('fixed', 1)
         self.brushes[-1].setLightOff()
         self.brushes[-1].setColorOff()
         self.brushes[-1].setColor(1, 1, 1, 0.05)
@@ -134,14 +196,221 @@ class BufferPainter:
                 for input in shader_inputs:
                     self.brushes[-1].setShaderInput(input, shader_inputs[input])
 
+    def brushRect(self, id, pos=None):
+        """ Returns the pixels of canvas id under the brush (x0, y0, x1, y1),
+        y is counted from the bottom of the canvas, same as the world y """
+        brush = self.brushes[id]
+        if pos is None:
+            pos = brush.getPos()
+        return BrushRect(pos, brush.getH(), self.brushSize, self.buffSize[id])
+
+    def readCanvas(self, id):
+        """ Returns a Texture with the ram image of canvas id, only the pixels changed since the last call
+        are read back from the gpu """
+        if self.__readBack(id) and not self.brushes[id].isHidden():
+            # the brush is drawn on the canvas but not painted, the next call reads it again
+            self.markDirty(id, self.brushRect(id, self.lastPointerPos), 'ram')
+            self.markDirty(id, self.brushRect(id), 'ram')
+        return self.images[id]
+
+    def __ramArray(self, id):
+        """ Returns the ram image read back from canvas id as a writable array [y][x][bytes], bottom row first """
+        image = self.images[id]
+        pixel = image.getNumComponents() * image.getComponentWidth()
+        ram = np.frombuffer(memoryview(image.modifyRamImage()), dtype=np.uint8)
+        return ram.reshape(self.buffSize[id], self.buffSize[id], pixel)
+
+    def __readBack(self, id):
+        """ Reads the pixels of canvas id changed since the last read back into its ram image,
+        returns False if nothing changed """
+        rect = self.popDirty(id, 'ram')
+        if not rect or rect[2] <= rect[0] or rect[3] <= rect[1]:
+            return False
+        x0, y0, x1, y1 = rect
+        size = float(self.buffSize[id])
+        self.regions[id].setDimensions(x0 / size, x1 / size, y0 / size, y1 / size)
+        image = self.regions[id].getScreenshot()
+        if self.images[id] is None:
+            self.images[id] = image
+            return True
+        ram = self.__ramArray(id)
+        if id in self.stroke:
+            # the ram image is still as it was before the stroke there, keep those tiles for undo
+            for tile in GetTiles(rect):
+                if tile not in self.stroke[id]:
+                    self.stroke[id][tile] = PackTile(ram, tile)
+        if (x1 - x0, y1 - y0) == (self.buffSize[id],) * 2:
+            self.images[id] = image
+        else:
+            # both have the bottom row first
+            ram[y0:y1, x0:x1] = np.frombuffer(image.getRamImage(), dtype=np.uint8).reshape(ram[y0:y1, x0:x1].shape)
+        return True
+
+    def loadCanvas(self, id, texture):
+        """ Replaces the content of canvas id with a texture, the strokes before can't be undone """
+        self.paintPlanes[id].setTexture(texture, 1)
+        self.brushes[id].setShaderInput('map', texture)
+        self.markDirty(id)
+        self.stroke.pop(id, None)
+        self.starts.pop(id, None)
+        self.last_stamp.pop(id, None)
+        self.history.clear()
+
+    def readCanvasLater(self, ids, callback):
+        """ Calls callback(textures) with the ram images of the canvases ids (see readCanvas) once this frame
+        is rendered, the brushes are not drawn in that frame so they are never read back with the canvas.
+        The read back itself is not overlapped with rendering: it's done right after the frame and waits
+        for the gpu to finish it (Panda3D 1.10 has no asynchronous read back). All the canvases are read
+        in that one frame and only the pixels changed since the last read back are copied """
+        self.hidden.update(ids)
+        self.synced.update(ids)
+        self.read_callbacks.append((ids, callback))
+
     def paint(self, id):
-        p = PNMImage(self.buffSize[id], self.buffSize[id], 4)
-        base.graphicsEngine.extractTextureData(self.textures[id], base.win.getGsg())
-        self.textures[id].store(p)
-        myTexture = Texture()
-        myTexture.load(p)
-        self.paintPlanes[id].setTexture(myTexture, 1)
-        self.brushes[id].setShaderInput('map', myTexture)
+        pos = Point3(self.brushes[id].getPos())
+        if id in self.synced or (id not in self.stroke and (self.images[id] is None or self.dirty[id].get('ram'))):
+            # the ram copy has to be up to date for undo, this frame only reads it back (without the brush
+            # drawn on the canvas), the stroke starts after it and the next paint stamps this spot too
+            self.starts.setdefault(id, pos)
+            self.hidden.add(id)
+            self.synced.add(id)
+            return
+        self.stroke.setdefault(id, {})
+        # the copy is made at the end of the frame, the brush may move before that
+        self.markDirty(id, self.brushRect(id, self.lastPointerPos))
+        self.markDirty(id, self.brushRect(id))
+        points = []
+        if id in self.starts:
+            points.append(self.starts.pop(id))
+        if id in self.last_stamp:
+            # fill the gap a fast stroke leaves since the last tick
+            points.extend(StampPoints(self.last_stamp[id], pos, self.brushSize, self.stamp_spacing))
+        for point in points[:1] + points[-1:]:
+            self.markDirty(id, self.brushRect(id, point))
+        self.__drawStamps(id, points)
+        self.last_stamp[id] = pos
+        self.buffers[id].triggerCopy()
+        self.painted.add(id)
+
+    def endStroke(self):
+        """ Ends the stroke (call it when the paint key or button goes up), all that was painted since
+        the stroke started is one undo step. It's read back after the next frame (with the brush hidden)
+        and then pushed to the history """
+        for id in [id for id in self.starts if id in self.stroke]:
+            # read back but not painted on yet, only the first stamp is drawn (without the brush)
+            start = self.starts.pop(id)
+            self.__drawStamps(id, [start])
+            self.markDirty(id, self.brushRect(id, start))
+            self.hidden.add(id)
+            self.buffers[id].triggerCopy()
+            self.painted.add(id)
+        self.starts = {}
+        self.last_stamp = {}
+        self.stroke_ended = True
+
+    def __pushStroke(self, ids):
+        """ Pushes the tiles the stroke changed on the canvases ids (read back by now) to the history """
+        step = []
+        for id in ids:
+            ram = self.__ramArray(id)
+            for tile, before in sorted(self.stroke.pop(id, {}).items()):
+                after = PackTile(ram, tile)
+                if after != before:
+                    step.append((id, tile, before, after))
+        if step:
+            self.history.push(step)
+
+    def __drawStamps(self, id, points):
+        """ Draws the brush of canvas id for one frame at the points (see StampPoints()), all the stamps
+        are one geom with the transform, texture, color and shader of the brush """
+        brush = self.brushes[id]
+        count = len(points)
+        if count < 1:
+            return
+        points = np.array([tuple(point) for point in points], dtype=np.float32)
+        # from the canvas to the brush space
+        mat = self.roots[id].getMat(brush)
+        mat = np.array([mat.getRow(i) for i in range(4)], dtype=np.float32)
+        offsets = np.hstack([points, np.ones((count, 1), dtype=np.float32)]).dot(mat)[:, :3]
+        # copies of the brush card
+        card = brush.node().getGeom(0).decompose()
+        vertex = GeomVertexReader(card.getVertexData(), 'vertex')
+        texcoord = GeomVertexReader(card.getVertexData(), 'texcoord')
+        corners = []
+        while not vertex.isAtEnd():
+            corners.append(tuple(vertex.getData3()) + tuple(texcoord.getData2()))
+        corners = np.array(corners, dtype=np.float32)
+        rows = np.repeat(corners[None, :, :], count, axis=0)
+        rows[:, :, :3] += offsets[:, None, :]
+        primitive = card.getPrimitive(0)
+        card_indices = np.array([primitive.getVertex(i) for i in range(primitive.getNumVertices())], dtype=np.uint32)
+        quads = card_indices[None, :] + np.arange(count, dtype=np.uint32)[:, None] * len(corners)
+        vertex_data = GeomVertexData('stamps', GeomVertexFormat.getV3t2(), Geom.UHStream)
+        vertex_data.uncleanSetNumRows(rows.shape[0] * rows.shape[1])
+        memoryview(vertex_data.modifyArray(0)).cast('B')[:] = rows.tobytes()
+        triangles = GeomTriangles(Geom.UHStream)
+        triangles.setIndexType(Geom.NTUint32)
+        indices = triangles.modifyVertices()
+        indices.uncleanSetNumRows(quads.size)
+        memoryview(indices).cast('B')[:] = quads.tobytes()
+        geom = Geom(vertex_data)
+        geom.addPrimitive(triangles)
+        node = GeomNode('stamps')
+        node.addGeom(geom)
+        # drawn like the brush, but not hidden with it
+        self.stamp_nodes.append(self.roots[id].attachNewNode(node))
+        self.stamp_nodes[-1].setTransform(brush.getTransform())
+        self.stamp_nodes[-1].setState(brush.getState())
+        # they come before the brush, so they are drawn first, all at the same depth so they can't write it
+        self.stamp_nodes[-1].setBin('fixed', 0)
+        self.stamp_nodes[-1].setDepthWrite(False)
+
+    def __putTiles(self, tiles):
+        """ Draws packed tiles [(id, tile, data)] on the canvases for a frame, then they are copied like strokes """
+        for id, tile, data in tiles:
+            ram = self.__ramArray(id)
+            pixels = UnpackTile(data, ram, tile)
+            x0, y0, x1, y1 = TileRect(tile, self.buffSize[id])
+            tex = Texture()
+            tex.setup2dTexture(x1 - x0, y1 - y0, self.images[id].getComponentType(), self.images[id].getFormat())
+            tex.setRamImage(pixels.tobytes())
+            tex.setMinfilter(SamplerState.FTNearest)
+            tex.setMagfilter(SamplerState.FTNearest)
+            scale = 512.0 / self.buffSize[id]
+            cm = CardMaker("tile")
+            cm.setFrame(x0 * scale, x1 * scale, y0 * scale, y1 * scale)
+            card = self.roots[id].attachNewNode(cm.generate())
+            card.lookAt(0, 0, -1)
+            card.setZ(-0.5)
+            card.setTexture(tex, 1)
+            card.setLightOff()
+            card.setTransparency(TransparencyAttrib.MNone)
+            self.tile_cards.append(card)
+            self.markDirty(id, [x0, y0, x1, y1])
+            self.hidden.add(id)
+            self.synced.add(id)
+            self.buffers[id].triggerCopy()
+            self.painted.add(id)
+
+    def undo(self):
+        """ Undoes the last stroke, returns False if there is nothing to undo """
+        if self.stroke or self.tile_cards:
+            return False
+        tiles = self.history.undo()
+        if tiles is None:
+            return False
+        self.__putTiles(tiles)
+        return True
+
+    def redo(self):
+        """ Redoes the last undone stroke, returns False if there is nothing to redo """
+        if self.stroke or self.tile_cards:
+            return False
+        tiles = self.history.redo()
+        if tiles is None:
+            return False
+        self.__putTiles(tiles)
+        return True
 
     def setBrushIDColor(self, id, color, keep_alpha=True):
         brush = self.brushes[id]
@@ -215,7 +484,60 @@ class BufferPainter:
         for brush in self.brushes:
             brush.setScale(new_size)
 
+    def __updateHeightPicker(self):
+        # the heights are read back once the stroke ends, not on every paint tick
+        if self.height_picker_id in self.stroke:
+            return
+        rect = self.popDirty(self.height_picker_id, 'picking')
+        if rect:
+            self.height_picker.updateFromTexture(self.readCanvas(self.height_picker_id), rect)
+
+    def __beforeRender(self, task):
+        for id in self.hidden:
+            if not self.brushes[id].isHidden():
+                self.brushes[id].hide()
+                self.unhide.add(id)
+        return task.cont
+
+    def __afterRender(self, task):
+        for id in self.painted:
+            # what was drawn got copied, the canvas is drawn over the copy from now on
+            self.paintPlanes[id].setTexture(self.copies[id], 1)
+            self.brushes[id].setShaderInput('map', self.copies[id])
+        for card in self.tile_cards:
+            card.removeNode()
+        self.tile_cards = []
+        for stamps in self.stamp_nodes:
+            stamps.removeNode()
+        self.stamp_nodes = []
+        # the brush is hidden, nothing unpainted to read back
+        for id in self.synced:
+            self.__readBack(id)
+        for id in self.unhide:
+            self.brushes[id].show()
+        self.painted = set()
+        self.synced = set()
+        self.hidden = set()
+        self.unhide = set()
+        callbacks = self.read_callbacks
+        self.read_callbacks = []
+        for ids, callback in callbacks:
+            callback([self.images[id] for id in ids])
+        for id, start in self.starts.items():
+            # read back now, the stroke starts from there
+            if id not in self.stroke:
+                self.stroke[id] = {}
+                self.last_stamp[id] = start
+        if self.stroke_ended:
+            # what the stroke painted is read back once, in a frame without the brush
+            self.stroke_ended = False
+            ids = sorted(self.stroke)
+            if ids:
+                self.readCanvasLater(ids, lambda images: self.__pushStroke(ids))
+        return task.cont
+
     def __getMousePos(self, task):
+        self.lastPointerPos = self.pointer.getPos()
         if base.mouseWatcherNode.hasMouse():
             mpos = base.mouseWatcherNode.getMouse()
             pos3d = Point3()
@@ -234,6 +556,17 @@ class BufferPainter:
                     for brush in self.brushes:
                         brush.setPos(self.pointer.getPos())
 
+            elif self.height_picker:
+                self.__updateHeightPicker()
+                near = render.getRelativePoint(camera, nearPoint)
+                hit = self.height_picker.pick(near, render.getRelativePoint(camera, farPoint) - near)
+                if hit is None and self.plane.intersectsLine(pos3d, near, render.getRelativePoint(camera, farPoint)):
+                    hit = pos3d
+                if hit is not None:
+                    self.pointer.setX(min(512.0, max(0.0, hit[0])))
+                    self.pointer.setY(min(512.0, max(0.0, hit[1])))
+                    for brush in self.brushes:
+                        brush.setPos(self.pointer.getPos())
             else:
                 if self.plane.intersectsLine(pos3d, render.getRelativePoint(camera, nearPoint),
                                              render.getRelativePoint(camera, farPoint)):
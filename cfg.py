@@ -1,4 +1,5 @@
 from panda3d.core import *
+import panda3d.core
 
 cfg = {}
 
@@ -26,6 +27,26 @@ def loadcfg():
     cfg['h_map_def'] = ConfigVariableString('koparka-default-height-map', "data/def_height.png").getValue()
     cfg['a_map_def'] = ConfigVariableString('koparka-default-attribute-map', "data/atr_def.png").getValue()
     cfg['terrain_mesh'] = ConfigVariableString('koparka-default-terrain-mesh', "data/mesh80k.bam").getValue()
+    # collision mesh
+    cfg['collision_grid_size'] = ConfigVariableInt('koparka-collision-grid-size', 200).getValue()
+    cfg['collision_egg'] = ConfigVariableBool('koparka-collision-egg', True).getValue()
+    cfg['collision_max_error'] = ConfigVariableDouble('koparka-collision-max-error', 0.0).getValue()
+    cfg['collision_cells'] = ConfigVariableInt('koparka-collision-cells', 4).getValue()
+    cfg['collision_cache_dir'] = ConfigVariableString('koparka-collision-cache-dir', "temp/collision_cache/").getValue()
+    cfg['collision_cache_size'] = ConfigVariableInt('koparka-collision-cache-size', 8).getValue()
+    # CollisionHeightfield is new in Panda3D 1.11, the option does nothing without it
+    cfg['collision_heightfield'] = (ConfigVariableBool('koparka-collision-heightfield', False).getValue() and
+                                    hasattr(panda3d.core, 'CollisionHeightfield'))
+    # navigation mesh
+    cfg['navmesh_binary'] = ConfigVariableBool('koparka-navmesh-binary', True).getValue()
+    cfg['navmesh_cluster_size'] = ConfigVariableInt('koparka-navmesh-cluster-size', 16).getValue()
+    cfg['navmesh_polygons'] = ConfigVariableBool('koparka-navmesh-polygons', False).getValue()
+    cfg['path_cache_size'] = ConfigVariableInt('koparka-path-cache-size', 64).getValue()
+    cfg['flow_field_cache_size'] = ConfigVariableInt('koparka-flow-field-cache-size', 16).getValue()
+    cfg['flow_field_step'] = ConfigVariableInt('koparka-flow-field-step', 4).getValue()
+    cfg['path_test_radius'] = ConfigVariableDouble('koparka-path-test-radius', 0.0).getValue()
+    cfg['undo_memory'] = ConfigVariableInt('koparka-undo-memory', 64).getValue()
+    cfg['brush_spacing'] = ConfigVariableDouble('koparka-brush-spacing', 0.25).getValue()
     cfg['sky_mesh'] = ConfigVariableString('koparka-default-skydome-mesh', "data/skydome2").getValue()
     cfg['sky_tex'] = ConfigVariableString('koparka-default-sky-tex', "data/clouds.png").getValue()
     cfg['sky_color'] = ConfigVariableString('koparka-default-sky-color-tex', "data/sky_grad.png").getValue()
@@ -76,6 +97,12 @@ def loadcfg():
     cfg['key_mode_walk'] = ConfigVariableString('koparka-key-walk-mode', 'f5').getValue()
     cfg['key_config'] = ConfigVariableString('koparka-key-config', 'f6').getValue()
     cfg['key_save'] = ConfigVariableString('koparka-key-save', 'f7').getValue()
+    cfg['key_cancel_jobs'] = ConfigVariableString('koparka-key-cancel-jobs', 'f8').getValue()
+    cfg['key_test_path'] = ConfigVariableString('koparka-key-test-path', 'p').getValue()
+    cfg['key_show_islands'] = ConfigVariableString('koparka-key-show-islands', 'i').getValue()
+    cfg['key_flow_field'] = ConfigVariableString('koparka-key-flow-field', 'f').getValue()
+    cfg['key_undo'] = ConfigVariableString('koparka-key-undo', 'control-z').getValue()
+    cfg['key_redo'] = ConfigVariableString('koparka-key-redo', 'control-y').getValue()
     cfg['key_h'] = ConfigVariableString('koparka-key-axis-h', '1').getValue()
     cfg['key_p'] = ConfigVariableString('koparka-key-axis-p', '2').getValue()
     cfg['key_r'] = ConfigVariableString('koparka-key-axis-r', '3').getValue()
@@ -91,3 +118,4 @@ def loadcfg():
     cfg['key_cam_zoomout2'] = ConfigVariableString('koparka-key-camera-zoomout2', '-').getValue()
     cfg['theme'] = ConfigVariableString('koparka-gui-theme', 'icon').getValue()
     cfg['use_gl_select'] = ConfigVariableBool('koparka-gl-select', False).getValue()
+    cfg['height_picking'] = ConfigVariableBool('koparka-height-picking', True).getValue()
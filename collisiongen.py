@@ -1,31 +1,488 @@
 from __future__ import print_function
-from panda3d.core import LPoint3d, CS_default
-from panda3d.egg import EggData
-#from math import floor
-
-def GenerateCollisionEgg(heightmap, output, input='data/collision3k.egg', scale=100.0):
-    input_egg = EggData()
-    input_egg.read(input)
-    output_egg = EggData()
-    output_egg.setCoordinateSystem(CS_default)
-    output_egg.stealChildren(input_egg)
-    VertexPool = output_egg.getChildren()[1]
-    print("Generating mesh, this may take a while...", end="")
-    for i in range(VertexPool.getHighestIndex()):
-        if i%20000 == 0:
-            try:
-                base.graphicsEngine.renderFrame()
-                print('.', end="")
-            except:
-                pass
-        vert = VertexPool.getVertex(i)
-        x0, y0, _ = vert.getPos3()
-        #x, y = int(floor(x0+0.5)), int(floor(y0+0.5))
-        x, y = int(x0), int(y0)
-        if x==512: x=511
-        elif x==0: x=1
-        if y==512: y=511
-        elif y==0: y=1
-        vert.setPos(LPoint3d(x0, y0, heightmap.getBright(x,512-y)*scale))
-
-    output_egg.writeEgg(output)
+from panda3d.core import NodePath, Point3
+from panda3d.core import BoundingVolume, CollisionNode, CollisionPolygon, PNMImage, Texture
+from direct.stdpy.file import open
+from helper import imageToArray
+import numpy as np
+import hashlib
+import os
+import shutil
+
+try:
+    from panda3d.core import CollisionHeightfield
+except ImportError:
+    # new in Panda3D 1.11
+    CollisionHeightfield = None
+
+
+def GetHeights(heightmap):
+    """ Returns a 2D float32 array where heights[y][x] == heightmap.getBright(x, y),
+    heightmap can be a PNMImage or a Texture with a ram image """
+    rgb = imageToArray(heightmap)
+    return rgb[..., 0] * 0.299 + rgb[..., 1] * 0.587 + rgb[..., 2] * 0.114
+
+
+def SampleHeights(heights, x, y, world_size=512.0):
+    """ Returns the heights under the world space points x, y (arrays),
+    the terrain covers world_size units no matter what size the heightmap is """
+    size_y, size_x = heights.shape
+    px = np.clip((np.asarray(x) * (size_x / world_size)).astype(np.int32), 1, size_x - 1)
+    py = np.clip((np.asarray(y) * (size_y / world_size)).astype(np.int32), 1, size_y - 1)
+    # the heightmap is upside down
+    return heights[size_y - py, px]
+
+
+def MakeHeightfield(heightmap, scale=100.0, world_size=512.0, subdivisions=4):
+    """ Returns a NodePath with a CollisionHeightfield of the heightmap (a PNMImage or a Texture
+    with a ram image) or None if this Panda3D has no CollisionHeightfield.
+    Rays are tested against the heightfield's own quadtree, there is no mesh and no file """
+    if CollisionHeightfield is None:
+        return None
+    image = PNMImage()
+    if isinstance(heightmap, Texture):
+        heightmap.store(image)
+    else:
+        image.copyFrom(heightmap)
+    # same weights as getBright()
+    image.makeGrayscale()
+    node = CollisionNode('collision_heightfield')
+    node.addSolid(CollisionHeightfield(image, scale, subdivisions))
+    heightfield = NodePath(node)
+    # one pixel is one unit in the heightfield, the terrain is world_size units big
+    heightfield.setScale(world_size / image.getXSize(), world_size / image.getYSize(), 1.0)
+    heightfield.setTag('z_scale', str(scale))
+    return heightfield
+
+
+def GridHeights(heights, resolution, scale=100.0, world_size=512.0):
+    """ Returns the z of every vertex of a resolution x resolution cell grid,
+    as a (resolution+1, resolution+1) array indexed [y][x] """
+    coords = np.linspace(0.0, world_size, resolution + 1)
+    x, y = np.meshgrid(coords, coords)
+    return SampleHeights(heights, x, y, world_size) * scale
+
+
+def GridMesh(z, world_size=512.0):
+    """ Returns the vertices (n, 3) and triangles (m, 3) of a regular grid,
+    z is a square array of vertex heights indexed [y][x] """
+    size = z.shape[0]
+    coords = np.linspace(0.0, world_size, size, dtype=np.float32)
+    x, y = np.meshgrid(coords, coords)
+    vertices = np.stack([x, y, z.astype(np.float32)], axis=-1).reshape(-1, 3)
+    index = np.arange(size * size, dtype=np.uint32).reshape(size, size)
+    a = index[:-1, :-1]
+    b = index[:-1, 1:]
+    c = index[1:, 1:]
+    d = index[1:, :-1]
+    # counter clockwise when seen from above
+    triangles = np.stack([a, b, c, a, c, d], axis=-1).reshape(-1, 3)
+    return vertices, triangles
+
+
+def _RtinChildren(a, b, c):
+    """ Splits right triangles (a, b, c) with the hypotenuse a-b in two, returns the midpoints and the children """
+    m = (a + b) // 2
+    return m, (np.concatenate([c, b]), np.concatenate([a, c]), np.concatenate([m, m]))
+
+
+def _TriangleErrors(flat, size, a, b, c):
+    """ Returns the largest difference between z (flat) and the plane of each triangle,
+    checked at every grid point the triangle covers """
+    errors = np.zeros(len(a), dtype=np.float32)
+    ia = a[:, 1] * (size + 1) + a[:, 0]
+    ib = b[:, 1] * (size + 1) + b[:, 0]
+    ic = c[:, 1] * (size + 1) + c[:, 0]
+    # triangles with the same shape share the grid points (relative to c) and their weights
+    shapes, group = np.unique(np.concatenate([a - c, b - c], axis=1), axis=0, return_inverse=True)
+    for i, (ux, uy, vx, vy) in enumerate(shapes.tolist()):
+        ids = np.nonzero(group.ravel() == i)[0]
+        ox, oy = np.meshgrid(np.arange(min(0, ux, vx), max(0, ux, vx) + 1),
+                             np.arange(min(0, uy, vy), max(0, uy, vy) + 1))
+        ox = ox.ravel()
+        oy = oy.ravel()
+        det = float(ux * vy - uy * vx)
+        wa = (ox * vy - oy * vx) / det
+        wb = (ux * oy - uy * ox) / det
+        wc = 1.0 - wa - wb
+        inside = (wa > -1e-6) & (wb > -1e-6) & (wc > -1e-6)
+        ox, oy, wa, wb, wc = ox[inside], oy[inside], wa[inside], wb[inside], wc[inside]
+        points = ic[ids, None] + oy * (size + 1) + ox
+        plane = flat[ia[ids], None] * wa + flat[ib[ids], None] * wb + flat[ic[ids], None] * wc
+        errors[ids] = np.abs(plane - flat[points]).max(axis=1)
+    return errors
+
+
+def _RtinErrors(z):
+    """ Returns the RTIN (right triangulated irregular network) error of every vertex of z,
+    a (2**n+1, 2**n+1) array. The error stored for the midpoint of a triangle hypotenuse
+    is the error of that triangle, but never less than the error of the smaller triangles
+    below it, so a mesh extracted with any threshold has no cracks """
+    size = z.shape[0] - 1
+    flat = z.ravel()
+    a = np.array([[size, size], [0, 0]])
+    b = np.array([[0, 0], [size, size]])
+    c = np.array([[size, 0], [0, size]])
+    levels = []
+    # the leaf triangles have legs 1 unit long
+    while np.abs(a[0] - c[0]).sum() > 1:
+        levels.append((a, b, c))
+        m, (a, b, c) = _RtinChildren(a, b, c)
+    errors = np.zeros(flat.shape, dtype=np.float32)
+    for a, b, c in reversed(levels):
+        error = _TriangleErrors(flat, size, a, b, c)
+        m = (a + b) // 2
+        left = (a + c) // 2
+        right = (b + c) // 2
+        error = np.maximum(error, errors[left[:, 1] * (size + 1) + left[:, 0]])
+        error = np.maximum(error, errors[right[:, 1] * (size + 1) + right[:, 0]])
+        np.maximum.at(errors, m[:, 1] * (size + 1) + m[:, 0], error)
+    return errors
+
+
+def AdaptiveMesh(z, max_error, world_size=512.0):
+    """ Returns the vertices, triangles and the largest error of a mesh that only keeps
+    the triangles needed to stay within max_error of z, a (2**n+1, 2**n+1) array """
+    size = z.shape[0] - 1
+    errors = _RtinErrors(z)
+    a = np.array([[size, size], [0, 0]])
+    b = np.array([[0, 0], [size, size]])
+    c = np.array([[size, 0], [0, size]])
+    kept = []
+    worst = 0.0
+    while len(a):
+        m = (a + b) // 2
+        error = errors[m[:, 1] * (size + 1) + m[:, 0]]
+        if np.abs(a[0] - c[0]).sum() > 1:
+            split = error > max_error
+        else:
+            split = np.zeros(len(a), dtype=bool)
+            error = np.zeros(len(a), dtype=np.float32)
+        keep = ~split
+        if keep.any():
+            kept.append(np.stack([a[keep], b[keep], c[keep]], axis=1))
+            worst = max(worst, float(error[keep].max()))
+        m, (a, b, c) = _RtinChildren(a[split], b[split], c[split])
+    corners = np.concatenate(kept)
+    # make all of them counter clockwise when seen from above
+    edge1 = corners[:, 1] - corners[:, 0]
+    edge2 = corners[:, 2] - corners[:, 0]
+    cw = edge1[:, 0] * edge2[:, 1] - edge1[:, 1] * edge2[:, 0] < 0
+    corners[cw] = corners[cw][:, [0, 2, 1]]
+    index = corners[..., 1] * (size + 1) + corners[..., 0]
+    used, triangles = np.unique(index, return_inverse=True)
+    y, x = np.divmod(used, size + 1)
+    step = world_size / size
+    vertices = np.stack([x * step, y * step, z.ravel()[used]], axis=-1).astype(np.float32)
+    return vertices, triangles.reshape(-1, 3).astype(np.uint32), worst
+
+
+def _NoProgress(fraction):
+    pass
+
+
+def SplitMesh(vertices, triangles, cells=4, world_size=512.0):
+    """ Splits the mesh into cells x cells square chunks (by triangle center),
+    returns a dict {(x, y): (used, triangles)}, the triangles of each chunk index its own
+    vertices, vertices[used] """
+    center = vertices[triangles].mean(axis=1)
+    cell = np.clip((center[:, :2] * (cells / world_size)).astype(np.int32), 0, cells - 1)
+    cell_id = cell[:, 1] * cells + cell[:, 0]
+    order = np.argsort(cell_id, kind='stable')
+    bounds = np.searchsorted(cell_id[order], np.arange(cells * cells + 1))
+    chunks = {}
+    for i in range(cells * cells):
+        chunk = triangles[order[bounds[i]:bounds[i + 1]]]
+        if len(chunk):
+            used, local = np.unique(chunk, return_inverse=True)
+            chunks[(i % cells, i // cells)] = (used, local.reshape(-1, 3).astype(np.uint32))
+    return chunks
+
+
+def CellName(cell):
+    return 'collision_{0}_{1}'.format(*cell)
+
+
+def CellEgg(name, vertices, triangles):
+    """ Returns the egg text of one chunk, a group of <Collide> polygons """
+    return ''.join(['<Group> ', name, ' {\n  <Collide> { Polyset descend }\n  <VertexPool> ', name, ' {\n'] +
+                   ['    <Vertex> %d { %.4f %.4f %.4f }\n' % (i, x, y, z)
+                    for i, (x, y, z) in enumerate(vertices.tolist())] +
+                   ['  }\n'] +
+                   ['  <Polygon> { <VertexRef> { %d %d %d <Ref> { %s } } }\n' % (a, b, c, name)
+                    for a, b, c in triangles.tolist()] +
+                   ['}\n'])
+
+
+def WriteCollisionEgg(output, chunks):
+    """ Writes the egg text of the chunks ({cell: text}) as one egg file, no template needed """
+    with open(output, 'w') as egg:
+        egg.write('<CoordinateSystem> { Z-up }\n')
+        for cell in sorted(chunks):
+            egg.write(chunks[cell])
+
+
+def MakeCellNode(name, vertices, triangles):
+    """ Returns a CollisionNode with one CollisionPolygon for each triangle """
+    node = CollisionNode(name)
+    points = [Point3(x, y, z) for x, y, z in vertices.tolist()]
+    for a, b, c in triangles.tolist():
+        node.addSolid(CollisionPolygon(points[a], points[b], points[c]))
+    # boxes fit flat terrain chunks a lot better than spheres
+    node.setBoundsType(BoundingVolume.BT_box)
+    return node
+
+
+class CollisionBuilder:
+    """
+    Builds the collision mesh and keeps it, so that after an edit only the cells
+    under the changed part of the heightmap are recomputed and patched.
+    """
+
+    def __init__(self, resolution=200, world_size=512.0, max_error=0.0, cells=4):
+        self.max_error = max_error
+        if max_error > 0.0:
+            resolution = 1 << int(resolution - 1).bit_length()
+        self.resolution = resolution
+        self.world_size = world_size
+        self.cells = cells
+        self.clear()
+
+    def clear(self):
+        self.mesh = None
+        self.scale = None
+        self.vertices = None  # all the vertices of the grid, z is a [y][x] view of the heights
+        self.z = None
+        self.chunks = {}  # {cell: (used, triangles, vertices)}
+        self.eggs = {}  # {cell: egg text}
+        self.saved = 0
+        self.error = 0.0
+
+    def needsUpdate(self, rect, scale):
+        return self.mesh is None or self.mesh.isEmpty() or rect is not None or scale != self.scale
+
+    def update(self, heightmap, rect=None, scale=100.0):
+        """ Returns the collision mesh for the heightmap, rect (x0, y0, x1, y1) are the heightmap
+        pixels that changed since the last update (rows counted from the bottom), None if no
+        pixels changed """
+        if not self.needsUpdate(rect, scale):
+            return self.mesh
+        return self.apply(self.compute(GetHeights(heightmap), rect, scale))
+
+    def state(self):
+        """ Returns what compute() needs to know about the mesh built so far, take it on the main thread
+        and give it to compute() when that runs on a worker, clear() and apply() don't change it """
+        return {'built': self.mesh is not None and not self.mesh.isEmpty(), 'scale': self.scale,
+                'vertices': self.vertices, 'z': self.z, 'chunks': dict(self.chunks),
+                'saved': self.saved, 'error': self.error}
+
+    def compute(self, heights, rect=None, scale=100.0, egg=False, state=None, progress=None):
+        """ The numpy part of update(), heights are the GetHeights() of the heightmap.
+        It doesn't change the builder or touch the scene graph, so it can run on a worker thread
+        (with the state() of the builder taken before), returns the changes for apply() with the
+        CollisionNodes of the changed cells. If egg is True the egg text of the changed cells is made too.
+        progress(fraction) is called now and then if given """
+        if progress is None:
+            progress = _NoProgress
+        if state is None:
+            state = self.state()
+        changes = {'scale': scale, 'rebuild': False, 'patch': False, 'cells': {}, 'nodes': {}, 'eggs': {},
+                   'vertices': state['vertices'], 'saved': state['saved'], 'error': state['error']}
+        size_y, size_x = heights.shape
+        if not state['built'] or scale != state['scale'] or rect is None \
+                or (rect[0] <= 0 and rect[1] <= 0 and rect[2] >= size_x and rect[3] >= size_y):
+            changes['rebuild'] = True
+            z = GridHeights(heights, self.resolution, scale, self.world_size)
+            vertices, triangles = GridMesh(z, self.world_size)
+            chunks = {}
+        else:
+            vertices = self._patch(heights, rect, changes, state)
+            if vertices is None:
+                return changes
+            triangles = None
+            chunks = state['chunks']
+        changes['vertices'] = vertices
+        progress(0.3)
+        z = vertices[:, 2].reshape(self.resolution + 1, self.resolution + 1)
+        if changes['patch']:
+            cells = changes['cells']
+        else:
+            if self.max_error > 0.0:
+                vertices, triangles, changes['error'] = AdaptiveMesh(z, self.max_error, self.world_size)
+                changes['saved'] = 2 * self.resolution * self.resolution - len(triangles)
+                print("{0} triangles ({1} saved), max error {2:.3f}...".format(len(triangles), changes['saved'],
+                                                                               changes['error']), end="")
+            cells = self._diffCells(vertices, triangles, chunks)
+            changes['cells'] = cells
+        progress(0.4)
+        for i, cell in enumerate(sorted(cells)):
+            if cells[cell] is not None:
+                used, cell_triangles, cell_vertices = cells[cell]
+                changes['nodes'][cell] = MakeCellNode(CellName(cell), cell_vertices, cell_triangles)
+                if egg:
+                    changes['eggs'][cell] = CellEgg(CellName(cell), cell_vertices, cell_triangles)
+            progress(0.4 + 0.6 * (i + 1) / len(cells))
+        return changes
+
+    def _diffCells(self, vertices, triangles, chunks):
+        """ Splits the triangles into cells, returns {cell: (used, triangles, vertices)} of the cells
+        that are different from chunks and {cell: None} for the cells that are gone """
+        split = SplitMesh(vertices, triangles, self.cells, self.world_size)
+        cells = dict.fromkeys(set(chunks) - set(split))
+        for cell, (used, cell_triangles) in split.items():
+            cell_vertices = vertices[used]
+            if cell in chunks:
+                old_used, old_triangles, old_vertices = chunks[cell]
+                if np.array_equal(old_triangles, cell_triangles) and np.array_equal(old_vertices, cell_vertices):
+                    continue
+            cells[cell] = (used, cell_triangles, cell_vertices)
+        return cells
+
+    def _patch(self, heights, rect, changes, state):
+        """ Samples the heights under rect again, returns a copy of the grid vertices
+        or None if no vertex moved """
+        size_y, size_x = heights.shape
+        # vertices that sample the changed pixels, with a one vertex margin
+        per_vertex = self.world_size / self.resolution
+        x0 = max(0, int(rect[0] * self.world_size / size_x / per_vertex) - 1)
+        y0 = max(0, int(rect[1] * self.world_size / size_y / per_vertex) - 1)
+        x1 = min(self.resolution + 1, int(rect[2] * self.world_size / size_x / per_vertex) + 2)
+        y1 = min(self.resolution + 1, int(rect[3] * self.world_size / size_y / per_vertex) + 2)
+        coords = np.linspace(0.0, self.world_size, self.resolution + 1)
+        x, y = np.meshgrid(coords[x0:x1], coords[y0:y1])
+        z = (SampleHeights(heights, x, y, self.world_size) * state['scale']).astype(np.float32)
+        changed = np.nonzero(z != state['z'][y0:y1, x0:x1])
+        if len(changed[0]) == 0:
+            return None
+        vertices = state['vertices'].copy()
+        vertices[:, 2].reshape(state['z'].shape)[y0:y1, x0:x1] = z
+        if self.max_error > 0.0:
+            # the whole RTIN is recomputed (it's cheap), but only the cells that came out different are rebuilt
+            return vertices
+        # the grid topology never changes, so only the z of the cells next to the changed vertices is patched
+        changes['patch'] = True
+        low = (np.array([changed[1].min() + x0, changed[0].min() + y0]) - 1) * per_vertex
+        high = (np.array([changed[1].max() + x0, changed[0].max() + y0]) + 1) * per_vertex
+        cell_size = self.world_size / self.cells
+        for cx in range(max(0, int(low[0] // cell_size)), min(self.cells, int(high[0] // cell_size) + 1)):
+            for cy in range(max(0, int(low[1] // cell_size)), min(self.cells, int(high[1] // cell_size) + 1)):
+                if (cx, cy) in state['chunks']:
+                    used, cell_triangles, cell_vertices = state['chunks'][(cx, cy)]
+                    changes['cells'][(cx, cy)] = (used, cell_triangles, vertices[used])
+        return vertices
+
+    def apply(self, changes):
+        """ Takes the result of compute() and (re)builds the nodes of the changed cells,
+        this one has to run on the main thread. Returns the mesh """
+        if changes is None:
+            return self.mesh
+        if changes['rebuild']:
+            if self.mesh is not None and not self.mesh.isEmpty():
+                self.mesh.removeNode()
+            self.mesh = NodePath('collision')
+            self.chunks = {}
+            self.eggs = {}
+        self.scale = changes['scale']
+        self.vertices = changes['vertices']
+        self.z = self.vertices[:, 2].reshape(self.resolution + 1, self.resolution + 1)
+        self.saved = changes['saved']
+        self.error = changes['error']
+        for cell, chunk in changes['cells'].items():
+            old = self.mesh.find(CellName(cell))
+            if chunk is None:
+                old.removeNode()
+                del self.chunks[cell]
+                del self.eggs[cell]
+                continue
+            if not old.isEmpty():
+                old.removeNode()
+            self.mesh.attachNewNode(changes['nodes'][cell])
+            self.chunks[cell] = chunk
+            self.eggs[cell] = changes['eggs'].get(cell)
+        self.mesh.setTag('triangles_saved', str(self.saved))
+        self.mesh.setTag('max_error', str(self.error))
+        self.mesh.setTag('z_scale', str(self.scale))
+        return self.mesh
+
+    def write(self, output=None, egg=None):
+        """ Writes the mesh to output (bam) and/or egg, only the egg text of changed cells is rebuilt """
+        if output:
+            self.mesh.writeBamFile(output)
+        if egg:
+            for cell, text in self.eggs.items():
+                if text is None:
+                    used, cell_triangles, cell_vertices = self.chunks[cell]
+                    self.eggs[cell] = CellEgg(CellName(cell), cell_vertices, cell_triangles)
+            WriteCollisionEgg(egg, self.eggs)
+
+
+class CollisionCache:
+    """
+    Keeps the last few generated collision files (bam and egg) in a directory, named by a hash of
+    the heights and the settings, so saving the same heightmap again only copies the files.
+    """
+    # change it when the generated files change, old files can't be used then
+    VERSION = 2
+
+    def __init__(self, directory='temp/collision_cache/', size=8):
+        self.directory = directory
+        self.size = size
+
+    def key(self, heights, *settings):
+        """ Returns the hash of the heights (GetHeights()) and settings (scale, resolution, etc) """
+        sha = hashlib.sha1(np.ascontiguousarray(heights, dtype=np.float32).tobytes())
+        sha.update(repr((self.VERSION, heights.shape) + settings).encode('ascii'))
+        return sha.hexdigest()
+
+    def _path(self, key, extension):
+        return os.path.join(self.directory, key + extension)
+
+    def get(self, key, output, egg=None):
+        """ Copies the cached files to output (bam) and egg, returns False if they are not cached """
+        if self.size <= 0 or key is None:
+            return False
+        files = [(self._path(key, '.bam'), output)]
+        if egg:
+            files.append((self._path(key, '.egg'), egg))
+        if not all(os.path.exists(cached) for cached, target in files):
+            return False
+        for cached, target in files:
+            shutil.copyfile(cached, target)
+            # the mtime is the last time it was used
+            os.utime(cached, None)
+        return True
+
+    def put(self, key, output, egg=None):
+        """ Adds the files to the cache, the least recently used ones are removed if there's too many """
+        if self.size <= 0 or key is None:
+            return
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        shutil.copyfile(output, self._path(key, '.bam'))
+        if egg:
+            shutil.copyfile(egg, self._path(key, '.egg'))
+        used = {}
+        for name in os.listdir(self.directory):
+            name_key, extension = os.path.splitext(name)
+            if extension in ('.bam', '.egg'):
+                mtime = os.path.getmtime(os.path.join(self.directory, name))
+                used[name_key] = max(used.get(name_key, mtime), mtime)
+        for old_key in sorted(used, key=used.get)[:max(0, len(used) - self.size)]:
+            for extension in ('.bam', '.egg'):
+                if os.path.exists(self._path(old_key, extension)):
+                    os.remove(self._path(old_key, extension))
+
+
+def GenerateCollisionMesh(heightmap, output=None, resolution=200, scale=100.0, world_size=512.0, egg=None,
+                          max_error=0.0, cells=4):
+    """ Builds a resolution x resolution collision grid straight from the heightmap,
+    returns a NodePath of CollisionNodes and writes it to output (bam) and/or egg if given.
+    If max_error > 0.0 the grid is simplified so that it stays within max_error units
+    of the full grid, the resolution is then rounded up to a power of two.
+    The mesh is split into cells x cells nodes (4x4 matches the ObjectPainter quadtree),
+    so collision rays can skip most of them by their bounds """
+    print("Generating mesh...", end="")
+    builder = CollisionBuilder(resolution, world_size, max_error, cells)
+    mesh = builder.update(heightmap, scale=scale)
+    builder.write(output, egg)
+    print("done")
+    return mesh
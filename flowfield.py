@@ -0,0 +1,137 @@
+from __future__ import print_function
+from helper import LRUCache, NEIGHBORS
+import math
+import numpy as np
+
+NO_DIRECTION = 255
+STEP_COSTS = [math.sqrt(2.0) if dx and dy else 1.0 for dx, dy in NEIGHBORS]
+
+
+def IntegrationField(walkable, goal):
+    """ Returns a float32 array with the path length (in cells) from each cell of the walkable
+    array [y][x] to the goal cell (x, y), inf where the goal can't be reached. Moves are the
+    links of the navmesh (8 directions, diagonals allowed if the cell they go to can be walked on).
+    Dijkstra in bands: every step costs at least 1, so all the open cells closer than the
+    closest one + 1 are done and expanded together, as arrays """
+    height, width = walkable.shape
+    stride = width + 2
+    grid = np.zeros((height + 2, stride), dtype=bool)
+    grid[1:-1, 1:-1] = walkable
+    grid = grid.ravel()
+    dist = np.full(grid.shape, np.inf)
+    closed = ~grid
+    offsets = [(dy * stride + dx, cost) for (dx, dy), cost in zip(NEIGHBORS, STEP_COSTS)]
+    goal = (goal[1] + 1) * stride + goal[0] + 1
+    if grid[goal]:
+        dist[goal] = 0.0
+        front = np.array([goal])
+    else:
+        front = np.zeros(0, dtype=np.intp)
+    while len(front):
+        front_dist = dist[front]
+        done = front_dist < front_dist.min() + 1.0
+        band = front[done]
+        closed[band] = True
+        found = [front[~done]]
+        for offset, cost in offsets:
+            cells = band + offset
+            new_dist = dist[band] + cost
+            keep = ~closed[cells]
+            cells, new_dist = cells[keep], new_dist[keep]
+            np.minimum.at(dist, cells, new_dist)
+            found.append(cells)
+        front = np.unique(np.concatenate(found))
+    return dist.reshape(height + 2, stride)[1:-1, 1:-1].astype(np.float32)
+
+
+def DirectionField(integration):
+    """ Returns a uint8 array with the index in NEIGHBORS of the way to go from each cell
+    (down the integration field), NO_DIRECTION at the goal and where the goal can't be reached """
+    height, width = integration.shape
+    padded = np.full((height + 2, width + 2), np.inf, dtype=np.float32)
+    padded[1:-1, 1:-1] = integration
+    costs = np.stack([padded[1 + dy:1 + dy + height, 1 + dx:1 + dx + width] + np.float32(cost)
+                      for (dx, dy), cost in zip(NEIGHBORS, STEP_COSTS)])
+    directions = np.argmin(costs, axis=0).astype(np.uint8)
+    directions[~np.isfinite(integration) | (integration == 0.0)] = NO_DIRECTION
+    return directions
+
+
+class FlowField:
+    """
+    The integration and direction fields of one goal cell, any number of agents can
+    follow it from wherever they are.
+    """
+
+    def __init__(self, walkable, goal):
+        self.goal = tuple(goal)
+        self.integration = IntegrationField(walkable, goal)
+        self.directions = DirectionField(self.integration)
+
+    def getDirection(self, cell):
+        """ Returns the (dx, dy) step to take from the cell, None at the goal or if it can't be reached """
+        x, y = cell
+        height, width = self.directions.shape
+        if 0 <= x < width and 0 <= y < height and self.directions[y, x] != NO_DIRECTION:
+            return NEIGHBORS[self.directions[y, x]]
+        return None
+
+    def getDistance(self, cell):
+        """ Returns the path length (in cells) from the cell to the goal, inf if there is no path """
+        return float(self.integration[cell[1], cell[0]])
+
+    def followPath(self, cell):
+        """ Returns the cells from the cell to the goal, [] if the goal can't be reached """
+        if not np.isfinite(self.getDistance(cell)):
+            return []
+        cells = [tuple(cell)]
+        step = self.getDirection(cell)
+        while step is not None:
+            cell = (cell[0] + step[0], cell[1] + step[1])
+            cells.append(cell)
+            step = self.getDirection(cell)
+        return cells
+
+
+class FlowFields:
+    """
+    Makes the flow fields of a walk grid (a bool array [y][x], like NavGrid.getWalkable()),
+    the fields of the last cache_size goals are kept.
+    """
+
+    def __init__(self, walkable, world_size=512.0, cache_size=16):
+        self.world_size = world_size
+        self.cache = LRUCache(cache_size)
+        self.setWalkable(walkable)
+
+    def setWalkable(self, walkable):
+        self.walkable = walkable
+        self.size_y, self.size_x = walkable.shape
+        self.cache.clear()
+
+    def getField(self, goal):
+        """ Returns the FlowField to the goal cell """
+        goal = tuple(goal)
+        field = self.cache.get(goal)
+        if field is None:
+            field = FlowField(self.walkable, goal)
+            self.cache.put(goal, field)
+        return field
+
+    def getCell(self, pos):
+        """ Returns the cell under a world position """
+        return (min(self.size_x - 1, max(0, int(pos[0] * self.size_x / self.world_size))),
+                min(self.size_y - 1, max(0, int(pos[1] * self.size_y / self.world_size))))
+
+    def getCellPos(self, cell):
+        """ Returns the world position (x, y) of the center of a cell """
+        return ((cell[0] + 0.5) * self.world_size / self.size_x, (cell[1] + 0.5) * self.world_size / self.size_y)
+
+    def getDirection(self, pos, goal):
+        """ Returns the world space (x, y) unit vector an agent at pos should move along to get to the goal cell,
+        (0, 0) at the goal or if it can't be reached """
+        step = self.getField(goal).getDirection(self.getCell(pos))
+        if step is None:
+            return (0.0, 0.0)
+        length = math.hypot(step[0], step[1])
+        return (step[0] / length, step[1] / length)
@@ -0,0 +1,157 @@
+from panda3d.core import Point3
+from collisiongen import GetHeights
+import math
+import numpy as np
+
+
+class HeightPicker:
+    """
+    Finds where a ray hits the terrain on the CPU, without a collision mesh or a picking buffer.
+    The terrain is taken as the heightmap sampled with linear filtering (as the terrain shader
+    sees it): a bilinear patch between each four texel centers. The highest and lowest point of
+    each patch and of each 2x2, 4x4... block of patches are kept in mip levels, the ray skips
+    over every block it passes above and only the patches it gets close to are solved exactly.
+    """
+
+    def __init__(self, world_size=512.0, scale=100.0):
+        self.world_size = world_size
+        self.scale = scale
+        self.size = 0
+        self.points = None
+        self.max_levels = []
+        self.min_levels = []
+
+    def setHeights(self, heights):
+        """ heights are GetHeights() of the heightmap (a 2D array, y from the top) """
+        self.update(heights)
+
+    def update(self, heights, rect=None):
+        """ Updates the levels where the heights changed, rect (x0, y0, x1, y1) are the changed
+        pixels (y from the bottom), None for all of them """
+        size = heights.shape[1]
+        if size != self.size or rect is None:
+            self.size = size
+            self.cell = self.world_size / size
+            # the texel centers, one more on each side for the edges (clamped like the texture)
+            self.origin = -0.5 * self.cell
+            self.points = np.pad(np.flipud(heights).astype(np.float32), 1, mode='edge')
+            levels = int(math.ceil(math.log(size + 1, 2)))
+            self.max_levels = [np.full((2 ** (levels - i),) * 2, -np.inf, dtype=np.float32) for i in range(levels + 1)]
+            self.min_levels = [np.full((2 ** (levels - i),) * 2, np.inf, dtype=np.float32) for i in range(levels + 1)]
+            rect = (0, 0, size, size)
+        else:
+            x0, y0, x1, y1 = rect
+            self.points[y0 + 1:y1 + 1, x0 + 1:x1 + 1] = np.flipud(heights)[y0:y1, x0:x1]
+            # the edge copies
+            self.points[0] = self.points[1]
+            self.points[-1] = self.points[-2]
+            self.points[:, 0] = self.points[:, 1]
+            self.points[:, -1] = self.points[:, -2]
+        x0, y0, x1, y1 = rect
+        # patch i is between points i and i + 1, a point changes the patches on both sides
+        x0, y0, x1, y1 = max(0, x0 - 1), max(0, y0 - 1), min(size + 1, x1 + 2), min(size + 1, y1 + 2)
+        corners = np.stack([self.points[y0:y1, x0:x1], self.points[y0:y1, x0 + 1:x1 + 1],
+                            self.points[y0 + 1:y1 + 1, x0:x1], self.points[y0 + 1:y1 + 1, x0 + 1:x1 + 1]])
+        self.max_levels[0][y0:y1, x0:x1] = corners.max(axis=0)
+        self.min_levels[0][y0:y1, x0:x1] = corners.min(axis=0)
+        for level in range(1, len(self.max_levels)):
+            x0, y0, x1, y1 = x0 // 2, y0 // 2, (x1 + 1) // 2, (y1 + 1) // 2
+            for levels, reduce in ((self.max_levels, np.maximum), (self.min_levels, np.minimum)):
+                below = levels[level - 1][y0 * 2:y1 * 2, x0 * 2:x1 * 2]
+                levels[level][y0:y1, x0:x1] = reduce(reduce(below[0::2, 0::2], below[0::2, 1::2]),
+                                                     reduce(below[1::2, 0::2], below[1::2, 1::2]))
+
+    def _solvePatch(self, i, j, ox, oy, oz, dx, dy, dz, t0, t1):
+        """ Returns the first t in t0...t1 where the ray hits patch i, j or None """
+        points = self.points
+        h00, h10 = float(points[j, i]), float(points[j, i + 1])
+        h01, h11 = float(points[j + 1, i]), float(points[j + 1, i + 1])
+        # u and v (0...1 over the patch) are linear in t, so the height is quadratic in t
+        x0 = self.origin + i * self.cell
+        y0 = self.origin + j * self.cell
+        au, bu = (ox - x0) / self.cell, dx / self.cell
+        av, bv = (oy - y0) / self.cell, dy / self.cell
+        ku, kv, kuv = h10 - h00, h01 - h00, h00 - h10 - h01 + h11
+        a = -kuv * bu * bv
+        b = dz - ku * bu - kv * bv - kuv * (au * bv + av * bu)
+        c = oz - h00 - ku * au - kv * av - kuv * au * av
+        if a * t0 * t0 + b * t0 + c <= 0.0:
+            return t0
+        if abs(a) < 1e-12:
+            roots = [-c / b] if b else []
+        else:
+            discriminant = b * b - 4.0 * a * c
+            if discriminant < 0.0:
+                return None
+            root = math.sqrt(discriminant)
+            roots = sorted(((-b - root) / (2.0 * a), (-b + root) / (2.0 * a)))
+        for t in roots:
+            if t0 <= t <= t1:
+                return t
+        return None
+
+    def pick(self, origin, direction):
+        """ Returns the Point3 where the ray from origin along direction (render space) first hits
+        the terrain, or None if it misses """
+        if self.points is None:
+            return None
+        ox, oy = float(origin[0]), float(origin[1])
+        dx, dy = float(direction[0]), float(direction[1])
+        # heights are kept from 0 to 1
+        oz, dz = float(origin[2]) / self.scale, float(direction[2]) / self.scale
+        # the part of the ray over the heightmap
+        low, high = self.origin, self.origin + (self.size + 1) * self.cell
+        t0, t1 = 0.0, float('inf')
+        for o, d in ((ox, dx), (oy, dy)):
+            if d == 0.0:
+                if not low <= o <= high:
+                    return None
+                continue
+            a, b = (low - o) / d, (high - o) / d
+            t0, t1 = max(t0, min(a, b)), min(t1, max(a, b))
+        top = float(self.max_levels[-1][0, 0])
+        if dz < 0.0:
+            t0 = max(t0, (oz - top) / -dz)
+        elif oz > top:
+            return None
+        top_level = len(self.max_levels) - 1
+        level = top_level
+        step = 1e-6 * self.cell / max(abs(dx), abs(dy), 1e-12)
+        t = t0
+        while t < t1:
+            size = self.cell * 2 ** level
+            x, y = ox + dx * t, oy + dy * t
+            i, j = int((x - low) // size), int((y - low) // size)
+            # where the ray leaves the block
+            t_exit = t1
+            if dx > 0.0:
+                t_exit = min(t_exit, (low + (i + 1) * size - ox) / dx)
+            elif dx < 0.0:
+                t_exit = min(t_exit, (low + i * size - ox) / dx)
+            if dy > 0.0:
+                t_exit = min(t_exit, (low + (j + 1) * size - oy) / dy)
+            elif dy < 0.0:
+                t_exit = min(t_exit, (low + j * size - oy) / dy)
+            levels = self.max_levels[level]
+            if not (0 <= i < levels.shape[1] and 0 <= j < levels.shape[0]):
+                return None
+            z_in, z_out = oz + dz * t, oz + dz * t_exit
+            if min(z_in, z_out) > levels[j, i]:
+                # above all of it
+                t = t_exit + step
+                level = min(level + 1, top_level)
+            elif z_in <= self.min_levels[level][j, i]:
+                # below all of it, so it was hit on the way in
+                return Point3(x, y, z_in * self.scale)
+            elif level:
+                level -= 1
+            else:
+                hit = self._solvePatch(i, j, ox, oy, oz, dx, dy, dz, t, t_exit)
+                if hit is not None:
+                    return Point3(ox + dx * hit, oy + dy * hit, (oz + dz * hit) * self.scale)
+                t = t_exit + step
+        return None
+
+    def updateFromTexture(self, texture, rect=None):
+        """ Updates the heights from a texture with a ram image (see update()) """
+        self.update(GetHeights(texture), rect)
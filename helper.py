@@ -1,4 +1,6 @@
-from panda3d.core import BitMask32
+from panda3d.core import BitMask32, Texture
+from collections import OrderedDict
+import numpy as np
 import re
 
 
@@ -19,6 +21,56 @@ def convertToPatches(model):
             geom_node.modify_geom(i).make_patches_in_place()
 
 
+def imageToArray(image):
+    """ Returns the RGB values of a PNMImage (or a Texture that has a ram image)
+    as a float32 array of shape (y_size, x_size, 3) with values in 0.0-1.0.
+    Rows are in PNMImage order, so array[y][x] is the same pixel as image.getXel(x, y) """
+    if isinstance(image, Texture):
+        tex = image
+    else:
+        tex = Texture()
+        tex.load(image)
+    dtype = {1: np.uint8, 2: np.uint16, 4: np.float32}[tex.getComponentWidth()]
+    data = np.frombuffer(tex.getRamImageAs('RGB'), dtype=dtype)
+    data = data.reshape(tex.getYSize(), tex.getXSize(), 3)
+    if dtype != np.float32:
+        data = data * np.float32(1.0 / np.iinfo(dtype).max)
+    # textures store the bottom row first
+    return np.flipud(data)
+
+
+class LRUCache:
+    """ A dict that keeps only the size most recently used items, size=0 keeps nothing """
+
+    def __init__(self, size=64):
+        self.size = size
+        self.items = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key, default=None):
+        if key not in self.items:
+            return default
+        value = self.items.pop(key)
+        self.items[key] = value
+        return value
+
+    def put(self, key, value):
+        if self.size <= 0:
+            return
+        self.items.pop(key, None)
+        self.items[key] = value
+        while len(self.items) > self.size:
+            self.items.popitem(last=False)
+
+    def clear(self):
+        self.items.clear()
+
+
 BUFFER_HEIGHT = 0
 BUFFER_ATR = 1
 BUFFER_GRASS = 2
@@ -50,6 +102,9 @@ WALK_MODE_WALK = 1
 GRASS_MODE_PAINT = 1
 GRASS_MODE_REMOVE = 0
 
+# neighbors of a walk grid cell, counter clockwise, the order of the navmesh rows
+NEIGHBORS = [(-1, 1), (-1, 0), (-1, -1), (0, -1), (1, -1), (1, 0), (1, 1), (0, 1)]
+
 MASK_WATER = BitMask32.bit(1)
 MASK_SHADOW = BitMask32.bit(2)
 MASK_TERRAIN_ONLY = BitMask32.bit(3)
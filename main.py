@@ -23,10 +23,14 @@ from direct.filter.FilterManager import FilterManager
 from camcon import CameraControler
 
 # -------------------- Project Files Imports -----------
-from buffpaint import BufferPainter
+from buffpaint import BufferPainter, WriteImage
 from guihelper import GuiHelper
-from collisiongen import GenerateCollisionEgg
-from navmeshgen import GenerateNavmeshCSV
+from collisiongen import CollisionBuilder, CollisionCache, GetHeights, MakeHeightfield
+from navmeshgen import GenerateNavmesh, GetWalkable, NavmeshUpdater
+from pathfinder import PathFinder
+from flowfield import FlowFields
+from walkoverlay import WalkOverlay
+from worker import BackgroundJob
 from objectpainter import ObjectPainter
 from sqliteloader import SaveScene, LoadScene
 from lightmanager import LightManager
@@ -153,6 +157,18 @@ class Editor(DirectObject):
         self.tempAlpha = 0.05
         self.ignoreHover = False
         self.collision_mesh = None
+        self.collision_builder = CollisionBuilder(resolution=cfg['collision_grid_size'],
+                                                  max_error=cfg['collision_max_error'],
+                                                  cells=cfg['collision_cells'])
+        self.collision_cache = CollisionCache(cfg['collision_cache_dir'], cfg['collision_cache_size'])
+        self.collision_key = None  # hash of the heights the collision mesh was made from
+        self.navmesh_updater = NavmeshUpdater()
+        self.path_finder = None
+        self.flow_fields = None
+        self.path_start = None  # cell where the test path starts
+        self.jobs = {}  # {name: BackgroundJob}
+        self.last_jobs = {}  # {name: BackgroundJob} the last one started, it may be cancelled but still running
+        self.jobs_done_commands = []
         self.winsize = [0, 0]
         self.object_mode = OBJECT_MODE_ONE
         self.hpr_axis = 'H: '
@@ -178,7 +194,8 @@ class Editor(DirectObject):
             if Filename(fname).getExtension() in ('png', 'tga', 'dds'):
                 self.brushList.append(cfg['brush_dir'] + fname)
 
-        self.painter = BufferPainter(self.brushList, showBuff=False)
+        self.painter = BufferPainter(self.brushList, showBuff=False, undo_memory=cfg['undo_memory'],
+                                     stamp_spacing=cfg['brush_spacing'])
         # BUFFER_HEIGHT
         self.painter.addCanvas(size=cfg['h_map_size'],
                                default_tex=cfg['h_map_def'],
@@ -194,15 +211,23 @@ class Editor(DirectObject):
         # BUFFER_ATR2=4
         self.painter.addCanvas(size=cfg['a_map_size'])
 
+        # test paths etc. drawn in walk mode
+        self.walk_overlay = WalkOverlay()
+
         # gl selection
         if cfg['use_gl_select']:
             self.painter.setup_gl_select(self.painter.textures[BUFFER_HEIGHT])
+        elif cfg['height_picking']:
+            self.painter.setupHeightPicking(BUFFER_HEIGHT)
 
     def init_gui(self):
         self.gui = GuiHelper(path, cfg['theme'])
         # tooltip bar
         self.tooltip = self.gui.addTooltip(self.gui.BottomLeft, (564, 32), y_offset=-96)
         self.tooltip.hide()
+        # progress of the background jobs
+        self.job_info = self.gui.addTooltip(self.gui.BottomLeft, (564, 32), y_offset=-128)
+        self.job_info.hide()
         # the toolbar_id here is just an int, not a 'toolbar object'!
         self.toolbar_id = self.gui.addToolbar(self.gui.TopLeft, (864, 32), icon_size=48,
                                               hover_command=self.onToolbarHover, color=(1, 1, 1, 0.0))
@@ -657,7 +682,7 @@ class Editor(DirectObject):
                        'scale_down': False}
 
         self.accept(cfg['key_paint'], self.keyMap.__setitem__, ['paint', True])
-        self.accept(cfg['key_paint'] + '-up', self.keyMap.__setitem__, ['paint', False])
+        self.accept(cfg['key_paint'] + '-up', self.stopPainting)
         self.accept(cfg['key_right'], self.keyMap.__setitem__, ['rotate_r', True])
         self.accept(cfg['key_right'] + '-up', self.keyMap.__setitem__, ['rotate_r', False])
         self.accept(cfg['key_left'], self.keyMap.__setitem__, ['rotate_l', True])
@@ -682,6 +707,12 @@ class Editor(DirectObject):
         self.accept(cfg['key_h'], self.setAxis, ['H: '])
         self.accept(cfg['key_p'], self.setAxis, ['P: '])
         self.accept(cfg['key_r'], self.setAxis, ['R: '])
+        self.accept(cfg['key_cancel_jobs'], self.cancelJobs)
+        self.accept(cfg['key_test_path'], self.testPath)
+        self.accept(cfg['key_show_islands'], self.showIslands)
+        self.accept(cfg['key_flow_field'], self.showFlowField)
+        self.accept(cfg['key_undo'], self.painter.undo)
+        self.accept(cfg['key_redo'], self.painter.redo)
         self.accept('escape', self.objectPainter.stop)
         self.accept('enter', self.focusOnProperties)
         self.accept('window-event', self.windowEventHandler)
@@ -912,6 +943,7 @@ class Editor(DirectObject):
             self.mesh.setShaderInput("water_level", WaterLevel)
             # self.mesh.setShaderInput("z_scale", TerrainScale)
             render.setShaderInput("z_scale", TerrainScale)
+            self.painter.setPickingScale(TerrainScale)
             self.mesh.setShaderInput("tex_scale", TerrainTile)
             if cfg['use_gl_select']:
                 self.painter.setup_gl_select(self.painter.textures[BUFFER_HEIGHT], TerrainScale)
@@ -1240,7 +1272,7 @@ class Editor(DirectObject):
             print("loading height map...", end=' ')
             file = path + save_dir + "/" + self.gui.entry2.get() + '.png'
             if exists(file):
-                self.painter.paintPlanes[BUFFER_HEIGHT].setTexture(loader.loadTexture(file))
+                self.painter.loadCanvas(BUFFER_HEIGHT, loader.loadTexture(file))
                 print("done")
             else:
                 print("FILE NOT FOUND!")
@@ -1249,14 +1281,14 @@ class Editor(DirectObject):
             print("loading detail map...", end=' ')
             file = path + save_dir + "/" + self.gui.entry3.get() + '0.png'
             if exists(file):
-                self.painter.paintPlanes[BUFFER_ATR].setTexture(loader.loadTexture(file))
+                self.painter.loadCanvas(BUFFER_ATR, loader.loadTexture(file))
                 print("ok...", end=' ')
             else:
                 print("FILE NOT FOUND!")
                 feedback += file + ' '
             file = path + save_dir + "/" + self.gui.entry3.get() + '1.png'
             if exists(file):
-                self.painter.paintPlanes[BUFFER_ATR2].setTexture(loader.loadTexture(file))
+                self.painter.loadCanvas(BUFFER_ATR2, loader.loadTexture(file))
                 print("done")
             else:
                 print("FILE NOT FOUND!")
@@ -1265,7 +1297,7 @@ class Editor(DirectObject):
             print("loading grass map...", end=' ')
             file = path + save_dir + "/" + self.gui.entry5.get() + '.png'
             if exists(file):
-                self.painter.paintPlanes[BUFFER_GRASS].setTexture(loader.loadTexture(file))
+                self.painter.loadCanvas(BUFFER_GRASS, loader.loadTexture(file))
                 print("done")
             else:
                 print("FILE NOT FOUND!")
@@ -1309,6 +1341,7 @@ class Editor(DirectObject):
                 self.skydome.setShaderInput("cloudSpeed", CloudSpeed)
                 self.mesh.setShaderInput("water_level", WaterLevel)
                 render.setShaderInput("z_scale", TerrainScale)
+                self.painter.setPickingScale(TerrainScale)
                 self.mesh.setShaderInput("tex_scale", TerrainTile)
                 if WaterLevel > 0.0:
                     self.wBuffer.setActive(True)
@@ -1334,15 +1367,18 @@ class Editor(DirectObject):
             else:
                 print("FILE NOT FOUND!")
                 feedback += file + ' '
-        if self.gui.flags[5]:  # collision
+        if self.gui.flags[5] and cfg['collision_heightfield']:
+            # the collision is made from the heightmap at the end
+            self.cancelJob('collision')
+        elif self.gui.flags[5]:  # collision
             print("loading collision mesh...", end=' ')
-            file = path + save_dir + "/" + self.gui.entry7.get() + '.egg'
+            file = path + save_dir + "/" + self.gui.entry7.get() + '.bam'
+            if not exists(file):
+                file = path + save_dir + "/" + self.gui.entry7.get() + '.egg'
             if exists(file):
-                if self.collision_mesh:
-                    self.collision_mesh.removeNode()
-                self.collision_mesh = loader.loadModel(file)
-                self.collision_mesh.reparentTo(render)
-                self.collision_mesh.setCollideMask(BitMask32.bit(1))
+                self.cancelJob('collision')
+                self.collision_builder.clear()
+                self.setCollisionMesh(loader.loadModel(file))
                 print("done")
             else:
                 print("FILE NOT FOUND!")
@@ -1351,11 +1387,17 @@ class Editor(DirectObject):
             print("loading navigation map...", end=' ')
             file = path + save_dir + "/" + self.gui.entry8.get() + ".png"
             if exists(file):
-                self.painter.paintPlanes[BUFFER_WALK].setTexture(loader.loadTexture(file))
+                self.painter.loadCanvas(BUFFER_WALK, loader.loadTexture(file))
                 print("done")
             else:
                 print("FILE NOT FOUND!")
                 feedback += file + ' '
+        if cfg['collision_heightfield']:
+            heightmap = None
+            if self.gui.flags[0] and exists(path + save_dir + "/" + self.gui.entry2.get() + '.png'):
+                # the height buffer is rendered next frame, the file is what it will have
+                heightmap = PNMImage(path + save_dir + "/" + self.gui.entry2.get() + '.png')
+            self.updatePickingCollision(heightmap)
         print("Loading DONE!")
         if feedback != "":
             self.gui.okDialog(text="Some files are missing:\n" + feedback, command=self.hideDialog)
@@ -1374,20 +1416,18 @@ class Editor(DirectObject):
                 return
         else:
             makedirs(Filename(path + save_dir).toOsSpecific())
+        # the maps are read back after this frame and written in the background
+        maps = []
         if self.gui.flags[0]:  # height map
-            print("saving height map...", end=' ')
-            self.painter.write(BUFFER_HEIGHT, path + save_dir + "/" + self.gui.entry2.get() + '.png')
-            print("done")
+            print("saving height map (in the background)...")
+            maps.append((BUFFER_HEIGHT, path + save_dir + "/" + self.gui.entry2.get() + '.png'))
         if self.gui.flags[1]:  # atr maps
-            print("saving detail map...", end=' ')
-            self.painter.write(BUFFER_ATR, path + save_dir + "/" + self.gui.entry3.get() + '0.png')
-            print("ok... ")
-            self.painter.write(BUFFER_ATR2, path + save_dir + "/" + self.gui.entry3.get() + '1.png')
-            print("done")
+            print("saving detail map (in the background)...")
+            maps.append((BUFFER_ATR, path + save_dir + "/" + self.gui.entry3.get() + '0.png'))
+            maps.append((BUFFER_ATR2, path + save_dir + "/" + self.gui.entry3.get() + '1.png'))
         if self.gui.flags[2]:  # grass map
-            print("saving grass map...", end=' ')
-            self.painter.write(BUFFER_GRASS, path + save_dir + "/" + self.gui.entry5.get() + '.png')
-            print("done")
+            print("saving grass map (in the background)...")
+            maps.append((BUFFER_GRASS, path + save_dir + "/" + self.gui.entry5.get() + '.png'))
         if self.gui.flags[4]:  # objects and textures used
             print("saving objects...", end=' ')
             # sky and water data
@@ -1423,17 +1463,119 @@ class Editor(DirectObject):
             SaveScene(path + save_dir + "/" + self.gui.entry6.get() + '.json', self.objectPainter.quadtree, extra_data)
             print("done")
         if self.gui.flags[5]:  # collison
-            print("saving collision mesh...", end=' ')
+            print("saving collision mesh (in the background)...")
             self.genCollision(True, path + save_dir + "/" + self.gui.entry7.get() + '.egg')
-            print("done")
+        navmesh = None
         if self.gui.flags[6]:  # navmesh
-            print("saving Navigation Mesh(CSV) and map...", end=' ')
-            map = self.painter.write(BUFFER_WALK, path + save_dir + "/" + self.gui.entry8.get() + '.png', True)
-            GenerateNavmeshCSV(map, path + save_dir + "/" + self.gui.entry8.get() + '.csv')
-            print("done")
+            print("saving Navigation Mesh(CSV) and map (in the background)...")
+            navmesh = path + save_dir + "/" + self.gui.entry8.get()
+            maps.append((BUFFER_WALK, navmesh + '.png'))
+        ids = [id for id, file in maps]
+        self.painter.readCanvasLater(ids, lambda images: self.writeMaps(maps, images, navmesh, save_dir))
+        self.hideSaveMenu()
+
+    def writeMaps(self, maps, images, navmesh, save_dir):
+        """ Writes the maps [(canvas id, file)] read back by save() as images, each on its own worker thread,
+        the walkmap is then made into the navmesh """
+        for (id, file), image in zip(maps, images):
+            on_done = on_cancel = None
+            if id == BUFFER_WALK:
+                # only the part painted since the last save is made again, an empty rect if nothing was
+                rect = self.painter.popDirty(BUFFER_WALK, 'navmesh') or (0, 0, 0, 0)
+                on_done = lambda map: self.saveNavmesh(navmesh, map, rect)
+                on_cancel = lambda: self.painter.markDirty(BUFFER_WALK, rect)
+            self.startJob('saving ' + Filename(file).getBasename(), WriteImage, (image.makeCopy(), file), on_done,
+                          on_cancel)
+        self.whenJobsDone(self.onSaveDone, [save_dir])
+
+    def saveNavmesh(self, file, map, rect):
+        """ Makes the navmesh files from the walkmap (a PNMImage) saved as file.png,
+        rect is the part of it painted since the last save (empty if nothing was) """
+        binary = None
+        if cfg['navmesh_binary']:
+            binary = file + '.nav'
+        clusters = None
+        if cfg['navmesh_cluster_size'] > 0:
+            clusters = file + '_clusters.json'
+        polygons = None
+        if cfg['navmesh_polygons']:
+            polygons = file + '_polygons.json'
+        self.startJob('navmesh', GenerateNavmesh,
+                      (map, file + '.csv', binary, clusters, cfg['navmesh_cluster_size'], polygons,
+                       self.navmesh_updater, rect),
+                      self.onNavmeshDone, on_cancel=lambda: self.painter.markDirty(BUFFER_WALK, rect))
+
+    def onSaveDone(self, save_dir):
         print("SAVING DONE!")
         self.gui.okDialog(text="Files saved to:\n" + save_dir, command=self.hideDialog)
-        self.hideSaveMenu()
+
+    def onNavmeshDone(self, result=None):
+        print("navmesh done")
+
+    # -------------- Background Jobs ------------------
+
+    def startJob(self, name, function, args=(), on_done=None, on_cancel=None):
+        """ Runs function(*args) on a worker thread, on_done(result) is called when it's done.
+        A job with the same name that is still running is cancelled first, the new one starts
+        only when its thread has ended (jobs with the same name write the same files) """
+        self.cancelJob(name)
+        after = self.last_jobs.get(name)
+        if after is not None and not after.isAlive():
+            after = None
+        self.jobs[name] = BackgroundJob(name, function, args,
+                                        on_done=lambda result: self.onJobDone(name, on_done, result),
+                                        on_progress=self.showJobs,
+                                        on_error=lambda exception: self.onJobError(name, on_cancel, exception),
+                                        on_cancel=on_cancel, after=after)
+        self.last_jobs[name] = self.jobs[name]
+        self.showJobs()
+
+    def onJobDone(self, name, command, result):
+        del self.jobs[name]
+        if command:
+            command(result)
+        self.showJobs()
+        if not self.jobs:
+            commands = self.jobs_done_commands
+            self.jobs_done_commands = []
+            for command, arg in commands:
+                command(*arg)
+
+    def onJobError(self, name, on_cancel, exception):
+        del self.jobs[name]
+        if on_cancel:
+            on_cancel()
+        # whatever waited for the jobs (like the 'Files saved' dialog) is dropped
+        self.jobs_done_commands = []
+        self.showJobs()
+        self.gui.okDialog(text=name + " failed:\n" + str(exception), command=self.hideDialog)
+
+    def cancelJob(self, name):
+        if name in self.jobs:
+            print(name + " cancelled")
+            self.jobs.pop(name).cancel()
+        self.showJobs()
+
+    def cancelJobs(self):
+        self.jobs_done_commands = []
+        for name in list(self.jobs):
+            self.cancelJob(name)
+
+    def whenJobsDone(self, command, arg=[]):
+        """ Calls command(*arg) now or when all the running jobs are done """
+        if self.jobs:
+            self.jobs_done_commands.append((command, arg))
+        else:
+            command(*arg)
+
+    def showJobs(self, fraction=None):
+        if self.jobs:
+            self.job_info['text'] = '   '.join('{0}: {1:.0%}'.format(name, job.progress)
+                                               for name, job in sorted(self.jobs.items()))
+            self.job_info['text'] += '   [' + cfg['key_cancel_jobs'].upper() + ']-Cancel'
+            self.job_info.show()
+        else:
+            self.job_info.hide()
 
     def setTex(self, layer, id, guiEvent=None):
         self.curent_textures[layer] = id
@@ -1564,7 +1706,7 @@ class Editor(DirectObject):
             self.painter.pointer.show()
             self.hpr_axis = ''
             self.accept('mouse1', self.keyMap.__setitem__, ['paint', True])
-            self.accept('mouse1-up', self.keyMap.__setitem__, ['paint', False])
+            self.accept('mouse1-up', self.stopPainting)
             self.gui.hideElement(self.palette_id)
             self.gui.showElement(self.toolbar_id)
             self.gui.showElement(self.heightmode_toolbar_id)
@@ -1596,7 +1738,7 @@ class Editor(DirectObject):
             self.painter.pointer.show()
             self.hpr_axis = ''
             self.accept('mouse1', self.keyMap.__setitem__, ['paint', True])
-            self.accept('mouse1-up', self.keyMap.__setitem__, ['paint', False])
+            self.accept('mouse1-up', self.stopPainting)
             self.gui.showElement(self.palette_id)
             self.gui.showElement(self.toolbar_id)
             self.gui.hideElement(self.mode_toolbar_id)
@@ -1629,7 +1771,7 @@ class Editor(DirectObject):
             self.painter.pointer.show()
             self.hpr_axis = ''
             self.accept('mouse1', self.keyMap.__setitem__, ['paint', True])
-            self.accept('mouse1-up', self.keyMap.__setitem__, ['paint', False])
+            self.accept('mouse1-up', self.stopPainting)
             self.gui.hideElement(self.palette_id)
             self.gui.showElement(self.toolbar_id)
             self.gui.hideElement(self.mode_toolbar_id)
@@ -1651,7 +1793,9 @@ class Editor(DirectObject):
         elif mode == MODE_OBJECT:
             if guiEvent != None:
                 self.hpr_axis = 'H: '
-                if self.collision_mesh == None:
+                if cfg['collision_heightfield']:
+                    self.updatePickingCollision()
+                elif self.collision_mesh == None:
                     self.gui.yesNoDialog("To place objects a collision mesh is needed.\nGenerate Collision Mesh?",
                                          self.genCollision, ['temp/collision.egg'])
             self.painter.hideBrushes()
@@ -1685,7 +1829,7 @@ class Editor(DirectObject):
             self.painter.pointer.show()
             self.hpr_axis = ''
             self.accept('mouse1', self.keyMap.__setitem__, ['paint', True])
-            self.accept('mouse1-up', self.keyMap.__setitem__, ['paint', False])
+            self.accept('mouse1-up', self.stopPainting)
             self.gui.hideElement(self.palette_id)
             self.gui.showElement(self.toolbar_id)
             self.gui.hideElement(self.mode_toolbar_id)
@@ -1704,31 +1848,171 @@ class Editor(DirectObject):
             self.mesh.setShaderInput("walkmap", self.painter.textures[BUFFER_WALK])
             self.mesh.setShader(Shader.load(Shader.SLGLSL, cfg["shader_terrain_w_v"], cfg["shader_terrain_w_f"]))
             render.setShaderInput("show_lights", 0.0)
+        if mode != MODE_WALK:
+            self.path_start = None
+            self.walk_overlay.clear()
+            self.walk_overlay.hideRegions()
+            self.walk_overlay.hideFlowField()
         self.mode = mode
         self.heading_info['text'] = self.hpr_axis + '%.0f' % self.painter.brushes[0].getH()
 
-    def genCollision(self, yes, file, guiEvent=None):
-        if yes:
-            if guiEvent != None:
-                self.gui.dialog.hide()
-                self.gui.wait.show()
-                base.graphicsEngine.renderFrame()
-                base.graphicsEngine.renderFrame()
-            heightmap = PNMImage(self.painter.buffSize[BUFFER_HEIGHT], self.painter.buffSize[BUFFER_HEIGHT], 4)
-            base.graphicsEngine.extractTextureData(self.painter.textures[BUFFER_HEIGHT], base.win.getGsg())
-            self.painter.textures[BUFFER_HEIGHT].store(heightmap)
-            GenerateCollisionEgg(heightmap, file, input='data/collision80k.egg', scale=self.gui.SkySeaOptions[1])
-            if self.collision_mesh:
-                self.collision_mesh.removeNode()
-            print("Loading mesh...")
-            self.collision_mesh = loader.loadModel(file, noCache=True)
-            self.collision_mesh.reparentTo(render)
-            self.collision_mesh.setCollideMask(BitMask32.bit(1))
+    def updatePathFinder(self):
+        """ Gives the path finder and the walk overlay the walkmap and heightmap as they are painted now """
+        rect = self.painter.popDirty(BUFFER_WALK, 'path')
+        if rect or self.path_finder is None:
+            walkable = GetWalkable(self.painter.readCanvas(BUFFER_WALK))
+            if self.path_finder is None or self.path_finder.regions.shape != walkable.shape:
+                self.path_finder = PathFinder(walkable, cache_size=cfg['path_cache_size'],
+                                              radii=[cfg['path_test_radius']])
+            else:
+                self.path_finder.updateWalkable(walkable, rect)
+            if self.flow_fields is None:
+                self.flow_fields = FlowFields(walkable, cache_size=cfg['flow_field_cache_size'])
+            else:
+                self.flow_fields.setWalkable(walkable)
+            self.walk_overlay.hideFlowField()
+        if self.painter.popDirty(BUFFER_HEIGHT, 'overlay') or self.walk_overlay.scale != self.gui.SkySeaOptions[1]:
+            self.walk_overlay.setHeights(GetHeights(self.painter.readCanvas(BUFFER_HEIGHT)), self.gui.SkySeaOptions[1])
+
+    def showIslands(self):
+        """ In walk mode shows (or hides) the parts of the walkmap that can't be reached from the biggest one """
+        if self.mode != MODE_WALK:
+            return
+        if self.walk_overlay.regions is not None:
+            self.walk_overlay.hideRegions()
+            return
+        self.updatePathFinder()
+        islands = self.walk_overlay.showRegions(self.path_finder.regions)
+        print("walkmap islands: {0}".format(islands))
+
+    def showFlowField(self):
+        """ In walk mode shows (or hides) the flow field to the cell under the pointer """
+        if self.mode != MODE_WALK:
+            return
+        if self.walk_overlay.flow is not None:
+            self.walk_overlay.hideFlowField()
+            return
+        self.updatePathFinder()
+        field = self.flow_fields.getField(self.flow_fields.getCell(self.painter.pointer.getPos()))
+        self.walk_overlay.showFlowField(field.directions, field.integration, cfg['flow_field_step'])
+
+    def testPath(self):
+        """ In walk mode the first press sets the start of a test path under the pointer,
+        the second one shows the path from there to the pointer """
+        if self.mode != MODE_WALK:
+            return
+        self.updatePathFinder()
+        cell = self.path_finder.getCell(self.painter.pointer.getPos())
+        if self.path_start is None:
+            self.path_start = cell
+            self.walk_overlay.clear()
+            self.walk_overlay.showMarker(self.path_finder.getCellPos(cell))
+            return
+        path = self.path_finder.findPath(self.path_start, cell, cfg['path_test_radius'])
+        self.walk_overlay.showMarker(self.path_finder.getCellPos(cell))
+        if path:
+            self.walk_overlay.showPath([self.path_finder.getCellPos(point) for point in path])
+            print("path length: {0:.1f}".format(self.path_finder.getPathLength(path)))
+        else:
+            self.walk_overlay.showMarker(self.path_finder.getCellPos(cell), color=(1.0, 0.0, 0.0, 1.0))
+            print("no path")
+        self.path_start = None
+
+    def updatePickingCollision(self, heightmap=None):
+        """ Makes the collision used to place objects straight from the heightmap (the height buffer
+        if None), no file is written. It's a CollisionHeightfield if this Panda3D has one, else the
+        collision mesh, kept in memory only """
+        scale = self.gui.SkySeaOptions[1]
+        rect = self.painter.popDirty(BUFFER_HEIGHT, 'heightfield')
+        if heightmap is None:
+            if rect is None and self.collision_mesh and self.collision_mesh.getTag('z_scale') == str(scale):
+                return
+            heightmap = self.painter.readCanvas(BUFFER_HEIGHT)
+        mesh = MakeHeightfield(heightmap, scale)
+        if mesh is None:
+            self.genCollision(True, None, heightmap=heightmap)
+            return
+        self.cancelJob('collision')
+        if self.collision_mesh:
+            self.collision_mesh.removeNode()
+        self.collision_builder.clear()
+        self.collision_mesh = mesh
+        self.collision_mesh.reparentTo(render)
+        self.collision_mesh.setCollideMask(BitMask32.bit(1))
+
+    def genCollision(self, yes, file, guiEvent=None, heightmap=None):
+        """ Builds the collision mesh in the background and writes it to file (bam, and egg if
+        koparka-collision-egg is set), with file=None the mesh is only kept in memory.
+        It's made from the height buffer, or all of it from heightmap (a PNMImage) if given """
         if guiEvent != None:
             self.gui.dialog.hide()
-            if yes:
-                self.gui.wait.hide()
+        if not yes:
+            return
+        egg_file = None
+        if cfg['collision_egg']:
+            egg_file = file
+        if file:
+            file = Filename(file).getFullpathWoExtension() + '.bam'
+        # a job that is still running gives its part of the heightmap back before we take it
+        self.cancelJob('collision')
+        # only the part of the heightmap painted since the last time is rebuilt
+        rect = self.painter.popDirty(BUFFER_HEIGHT, 'collision')
+        scale = self.gui.SkySeaOptions[1]
+        builder = self.collision_builder
+        if heightmap is not None:
+            # a map that was just loaded, the height buffer has not rendered it yet
+            rect = None
+            heights = GetHeights(heightmap)
+        elif builder.needsUpdate(rect, scale):
+            # the worker gets its own copy of the heights, painting can go on
+            heights = GetHeights(self.painter.readCanvas(BUFFER_HEIGHT))
+        else:
+            heights = None
+        if heights is not None:
+            key = self.collision_cache.key(heights, scale, builder.resolution, builder.max_error, builder.cells)
+        else:
+            key = self.collision_key
+        if file and self.collision_cache.get(key, file, egg_file):
+            print("collision mesh found in the cache")
+            if heights is not None:
+                self.setCollisionMesh(loader.loadModel(file, noCache=True))
+                # the builder has no mesh to patch now, it starts over the next time
+                builder.clear()
+            self.collision_key = key
+            if guiEvent != None:
                 self.gui.okDialog(text="Collision mesh saved to:\n" + file, command=self.hideDialog)
+            return
+        on_done = lambda changes: self.onCollisionDone(changes, file, egg_file, key, guiEvent != None)
+        if heights is None:
+            on_done(None)
+            return
+        print("Generating mesh...")
+        self.startJob('collision', builder.compute, (heights, rect, scale, egg_file is not None, builder.state()),
+                      on_done, on_cancel=lambda: self.painter.markDirty(BUFFER_HEIGHT, rect))
+
+    def onCollisionDone(self, changes, file, egg_file, key, show_dialog):
+        mesh = self.collision_builder.apply(changes)
+        self.collision_builder.write(file, egg_file)
+        if file:
+            self.collision_cache.put(key, file, egg_file)
+        self.collision_key = key
+        print("collision mesh done")
+        self.setCollisionMesh(mesh)
+        if show_dialog:
+            self.gui.okDialog(text="Collision mesh saved to:\n" + file, command=self.hideDialog)
+
+    def setCollisionMesh(self, mesh):
+        """ Makes mesh the collision the objects are placed on """
+        # with a heightfield to place objects on, the mesh is just for the files
+        if self.collision_mesh and self.collision_mesh.getName() == 'collision_heightfield':
+            return
+        if self.collision_mesh and self.collision_mesh != mesh:
+            self.collision_mesh.removeNode()
+        self.collision_mesh = mesh
+        self.collision_mesh.reparentTo(render)
+        self.collision_mesh.setCollideMask(BitMask32.bit(1))
+        # files saved by older versions can have visible geometry, rays still hit it when hidden
+        self.collision_mesh.hide()
 
     def nextModel(self):
         if self.mode == MODE_OBJECT:
@@ -1744,6 +2028,11 @@ class Editor(DirectObject):
             if self.object_mode == OBJECT_MODE_WALL:
                 self.nextWall(direction=-1)
 
+    def stopPainting(self):
+        """ The paint key or button went up, what was painted since it went down is one undo step """
+        self.keyMap['paint'] = False
+        self.painter.endStroke()
+
     def update(self):
         if self.mode == MODE_HEIGHT:
             if self.keyMap['paint']:
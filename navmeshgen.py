@@ -1,79 +1,406 @@
-from panda3d.core import PNMImage
+from panda3d.core import PNMImage, Filename, Texture
 from direct.stdpy.file import open
+from helper import imageToArray, NEIGHBORS
+from pathfinder import ClusterGraph, GetClearance, GetRegions, PolygonGraph, UpdateClearance, UpdateRegions
+import numpy as np
+import os
+import struct
 
+NULL_NODE = '1,0,0,0,0,0,0,0,0,0\n'
+NULL_NEIGHBOR = '1,1,0,0,0,0,0,0,0,0\n'
+# binary navmesh, see WriteNavGrid()
+NAV_MAGIC = b'KNAV'
+NAV_VERSION = 1
+NAV_HEADER = struct.Struct('<4sHHIf')
+NAV_SECTION = struct.Struct('<4s4sI4xQ')
 
-def GetNeighbors(pos, map, map_size, world_map_size=512.0):
-    node_size = world_map_size / map_size
-    nods = []
-    if map.getRedVal(pos[0], (map_size - 1) - pos[1]) < 0.5:
-        nods.append({'NULL': 0,
-                     'NodeType': 0,
-                     'GridX': pos[0],
-                     'GridY': pos[1],
-                     'Length': 8,
-                     'Width': 8,
-                     'Height': 0,  # not used
-                     'PosX': pos[0] * node_size + node_size / 2,
-                     'PosY': pos[1] * node_size + node_size / 2,
-                     'PosZ': 0  # not used
-                     })
-    else:
-        nods.append({'NULL': 1, 'NodeType': 0, 'GridX': 0, 'GridY': 0, 'Length': 0, 'Width': 0, 'Height': 0, 'PosX': 0,
-                     'PosY': 0, 'PosZ': 0})
-        return nods
-    coords = [(-1, 1), (-1, 0), (-1, -1), (0, -1), (1, -1), (1, 0), (1, 1), (0, 1)]  # counter clockwise
-    for coord in coords:
-        x = pos[0] + coord[0]
-        y = pos[1] + coord[1]
-        map_y = (map_size - 1) - y  # map is upside down
-        if (x < map_size and x > -1) and (map_y < map_size and map_y > -1):
-            if map.getRedVal(x, map_y) < 0.5:
-                nods.append({'NULL': 0,
-                             'NodeType': 1,
-                             'GridX': x,
-                             'GridY': y,
-                             'Length': 8,
-                             'Width': 8,
-                             'Height': 0,  # not used
-                             'PosX': x * node_size + node_size / 2,
-                             'PosY': y * node_size + node_size / 2,
-                             'PosZ': 0  # not used
-                             })
-            else:
-                nods.append(
-                    {'NULL': 1, 'NodeType': 1, 'GridX': 0, 'GridY': 0, 'Length': 0, 'Width': 0, 'Height': 0, 'PosX': 0,
-                     'PosY': 0, 'PosZ': 0})
-        else:  # out of map
-            nods.append(
-                {'NULL': 1, 'NodeType': 1, 'GridX': 0, 'GridY': 0, 'Length': 0, 'Width': 0, 'Height': 0, 'PosX': 0,
-                 'PosY': 0, 'PosZ': 0})
-    return nods
-
-
-def GenerateNavmeshCSV(map, output):
-    # check the map size
+
+def GetWalkable(map):
+    """ Returns a bool array where walkable[y][x] is True if the cell can be walked on (no red),
+    y is counted from the bottom of the map (GridY), the map is upside down.
+    The map is a PNMImage or a Texture with a ram image """
+    if not isinstance(map, Texture) and map.isGrayscale():
+        # PNMImage keeps the gray in the blue channel, getRedVal() is always 0
+        return np.ones((map.getReadYSize(), map.getReadXSize()), dtype=bool)
+    return np.flipud(imageToArray(map)[..., 0] == 0.0)
+
+
+def SquareMap(map):
+    """ Returns the map scaled to map.getReadXSize() x map.getReadXSize() if it's not square """
     map_size = map.getReadXSize()
-    # make it square
     if map.getReadYSize() != map_size:
         new_map = PNMImage(map_size, map_size)
         new_map.boxFilterFrom(0.0, map)
         map = new_map
+    return map
+
+
+def GetLinks(walkable):
+    """ Returns a uint8 array, bit i of links[y][x] is set if the cell can be walked on and so can
+    its neighbor NEIGHBORS[i], same as the NodeType 1 rows of the CSV """
+    height, width = walkable.shape
+    padded = np.zeros((height + 2, width + 2), dtype=bool)
+    padded[1:-1, 1:-1] = walkable
+    links = np.zeros(walkable.shape, dtype=np.uint8)
+    for i, (dx, dy) in enumerate(NEIGHBORS):
+        links |= padded[1 + dy:1 + dy + height, 1 + dx:1 + dx + width].astype(np.uint8) << i
+    links[~walkable] = 0
+    return links
+
+
+def NavmeshRows(walkable, world_map_size=512.0, progress=None, y0=0, y1=None):
+    """ Yields the CSV rows of the navmesh of a square walkable array (see GetWalkable)
+    as one string per grid row (y), only three grid rows are kept at a time.
+    Each walkable cell has a row for itself and one for each of its NEIGHBORS,
+    a cell that is not walkable only has a NULL_NODE row. Only the grid rows from y0 to y1
+    (not included) are made if given """
+    map_size = walkable.shape[0]
+    if y1 is None:
+        y1 = map_size
+    node_size = world_map_size / map_size
+    grid = [str(i) for i in range(map_size)]
+    pos = [str(i * node_size + node_size / 2) for i in range(map_size)]
+    # a border of cells that are not walkable, so the edge cells have no neighbors out of the map
+    padded = np.zeros((map_size + 2, map_size + 2), dtype=bool)
+    padded[1:-1, 1:-1] = walkable
+    x = np.arange(map_size)
+
+    def neighbor_rows(y):
+        if y < 0 or y >= map_size:
+            return [''] * map_size
+        return ['0,1,{0},{1},8,8,0,{2},{3},0\n'.format(grid[i], grid[y], pos[i], pos[y]) for i in range(map_size)]
+
+    # the rows of the cells of y-1, y and y+1 as neighbors
+    window = [neighbor_rows(y0 - 1), neighbor_rows(y0), neighbor_rows(y0 + 1)]
+    index = np.empty((map_size, 9), dtype=np.intp)
+    for y in range(y0, y1):
+        if y > y0:
+            window = window[1:] + [neighbor_rows(y + 1)]
+        # 0, 1 and 2 are the empty rows, then the cells of y as nodes, then the window
+        table = np.array([NULL_NODE, NULL_NEIGHBOR, ''] + ['0,0' + row[3:] for row in window[1]] +
+                         window[0] + window[1] + window[2], dtype=object)
+        center = padded[y + 1, 1:-1]
+        index[:, 0] = np.where(center, 3 + x, 0)
+        for i, (dx, dy) in enumerate(NEIGHBORS):
+            index[:, i + 1] = np.where(padded[y + 1 + dy, 1 + dx:1 + dx + map_size],
+                                       3 + map_size * (2 + dy) + x + dx, 1)
+        index[~center, 1:] = 2
+        yield ''.join(table[index.ravel()].tolist())
+        if progress:
+            progress((y + 1.0 - y0) / (y1 - y0))
+
+
+def _TextBytes(text):
+    """ Returns how many bytes text takes in a file written in text mode ('\n' is os.linesep) """
+    return len(text) + text.count('\n') * (len(os.linesep) - 1)
 
-        # generate data
-    nods = []
-    for y in range(0, map_size):
-        for x in range(0, map_size):
-            nods += GetNeighbors((x, y), map, map_size)
 
-            # write data
+def WriteNavmeshCSV(output, walkable, world_map_size=512.0, progress=None, chunk_size=1 << 20):
+    """ Writes the navmesh CSV of a square walkable array (see GetWalkable) to output.
+    The rows are written as they are made, about chunk_size characters at a time.
+    Returns the size of the header and of each grid row in the file (in bytes) """
+    map_size = walkable.shape[0]
+    row_bytes = np.zeros(map_size, dtype=np.int64)
     with open(output, 'w') as output_file:
         # header
-        output_file.write('Grid Size,' + str(map_size) + '\n')
-        output_file.write('NULL,NodeType,GridX,GridY,Length,Width,Height,PosX,PosY,PosZ\n')
+        header = 'Grid Size,' + str(map_size) + '\n' + 'NULL,NodeType,GridX,GridY,Length,Width,Height,PosX,PosY,PosZ\n'
+        output_file.write(header)
         # data...
-        for nod in nods:
-            output_file.write(
-                '{NULL},{NodeType},{GridX},{GridY},{Length},{Width},{Height},{PosX},{PosY},{PosZ}\n'.format(**nod))
+        chunk = []
+        length = 0
+        for y, rows in enumerate(NavmeshRows(walkable, world_map_size, progress)):
+            chunk.append(rows)
+            length += len(rows)
+            row_bytes[y] = _TextBytes(rows)
+            if length >= chunk_size:
+                output_file.write(''.join(chunk))
+                chunk = []
+                length = 0
+        output_file.write(''.join(chunk))
+    return _TextBytes(header), row_bytes
+
+
+def GenerateNavmeshCSV(map, output, progress=None, chunk_size=1 << 20):
+    """ Writes the navmesh of the walkmap (a PNMImage) to output, progress(fraction)
+    is called after every row if given, so this can run on a worker thread """
+    WriteNavmeshCSV(output, GetWalkable(SquareMap(map)), progress=progress, chunk_size=chunk_size)
+
+
+def WriteNavGrid(output, walkable, world_map_size=512.0, sections=()):
+    """ Writes the binary navmesh of a square walkable array (see GetWalkable).
+    The file is a header (magic 'KNAV', version, number of sections, grid size and world size)
+    and then sections, each with a 24 byte header (tag, numpy dtype, columns, data size in bytes)
+    and the data of a 2D array, padded to 8 bytes. The sections are:
+    'WALK' the walkable cells as bits (np.packbits of the rows, y from the bottom),
+    'LINK' GetLinks(), one byte per cell, and then any (tag, array) of sections """
+    map_size = walkable.shape[0]
+    sections = [(b'WALK', np.packbits(walkable, axis=1)), (b'LINK', GetLinks(walkable))] + list(sections)
+    with open(output, 'wb') as output_file:
+        output_file.write(NAV_HEADER.pack(NAV_MAGIC, NAV_VERSION, len(sections), map_size, world_map_size))
+        for tag, data in sections:
+            data = np.ascontiguousarray(data)
+            dtype = data.dtype.newbyteorder('<').str.encode('ascii')
+            output_file.write(NAV_SECTION.pack(tag, dtype, data.shape[1], data.nbytes))
+            output_file.write(data.astype(dtype, copy=False).tobytes())
+            output_file.write(b'\0' * (-data.nbytes % 8))
+
+
+def GenerateNavmeshBinary(map, output, world_map_size=512.0):
+    """ Writes the binary navmesh of the walkmap (a PNMImage) to output, read it with NavGrid.
+    It has a 'REGN' section with the region of each cell (see pathfinder.GetRegions) and a 'CLRC'
+    section with the clearance of each cell in cells (see pathfinder.GetClearance) """
+    walkable = GetWalkable(SquareMap(map))
+    WriteNavGrid(output, walkable, world_map_size,
+                 [(b'REGN', GetRegions(walkable)), (b'CLRC', GetClearance(walkable))])
+
+
+def GenerateNavmeshClusters(map, output, cluster_size=16):
+    """ Writes the HPA* cluster graph of the walkmap (a PNMImage) to output, see pathfinder.ClusterGraph """
+    graph = ClusterGraph(cluster_size=cluster_size)
+    graph.build(GetWalkable(SquareMap(map)))
+    graph.write(output)
+
+
+def GenerateNavmeshPolygons(map, output):
+    """ Writes the walkmap (a PNMImage) merged into rectangles with the portals between them,
+    a graph with far fewer nodes than the cells, see pathfinder.PolygonGraph """
+    PolygonGraph().build(GetWalkable(SquareMap(map))).write(output)
+
+
+def GenerateNavmesh(map, csv=None, binary=None, clusters=None, cluster_size=16, polygons=None, updater=None,
+                    rect=None, progress=None):
+    """ Writes the CSV, the binary navmesh, the cluster graph and/or the polygon graph of the walkmap.
+    With a NavmeshUpdater the CSV and binary navmesh are only patched where the walkmap changed,
+    rect (x0, y0, x1, y1) is the part of the walkmap that may have changed since the last time
+    (None if that's not known, an empty rect if nothing did) """
+    if updater:
+        updater.update(map, csv, binary, rect, progress)
+        csv = binary = None
+    if binary:
+        GenerateNavmeshBinary(map, binary)
+    if clusters:
+        GenerateNavmeshClusters(map, clusters, cluster_size)
+    if polygons:
+        GenerateNavmeshPolygons(map, polygons)
+    if csv:
+        GenerateNavmeshCSV(map, csv, progress)
+
+
+class NavGrid:
+    """
+    Reads a binary navmesh (see WriteNavGrid), the file is memory-mapped so nothing is parsed,
+    the sections are numpy arrays backed by the file.
+    """
+
+    def __init__(self, filename, writable=False):
+        self.data = np.memmap(Filename(filename).toOsSpecific(), dtype=np.uint8, mode='r+' if writable else 'r')
+        magic, version, count, self.size, self.world_size = NAV_HEADER.unpack_from(self.data, 0)
+        if magic != NAV_MAGIC:
+            raise IOError(filename + ' is not a navmesh')
+        if version > NAV_VERSION:
+            raise IOError(filename + ' needs a newer navmesh reader (version {0})'.format(version))
+        self.node_size = self.world_size / self.size
+        self.sections = {}
+        offset = NAV_HEADER.size
+        for i in range(count):
+            tag, dtype, columns, length = NAV_SECTION.unpack_from(self.data, offset)
+            offset += NAV_SECTION.size
+            dtype = np.dtype(dtype.rstrip(b'\0').decode('ascii'))
+            self.sections[tag.decode('ascii')] = np.ndarray((length // dtype.itemsize // columns, columns), dtype,
+                                                            self.data, offset)
+            offset += length + (-length % 8)
+        self.walk = self.sections['WALK']
+        self.links = self.sections['LINK']
+        self.regions = self.sections.get('REGN')
+        if self.regions is None:
+            self.regions = GetRegions(self.getWalkable())
+        self.clearance = self.sections.get('CLRC')
+        if self.clearance is None:
+            self.clearance = GetClearance(self.getWalkable())
+
+    def section(self, tag):
+        """ Returns the array of a section or None if the file has no such section """
+        return self.sections.get(tag)
+
+    def isWalkable(self, x, y, radius=0.0):
+        """ Returns True if an agent of the radius (in world units) can stand on the cell """
+        if 0 <= x < self.size and 0 <= y < self.size:
+            if radius > 0.0:
+                return bool(self.clearance[y, x] >= radius / self.node_size + 0.5)
+            return bool(self.walk[y, x >> 3] & (0x80 >> (x & 7)))
+        return False
+
+    def getWalkable(self, radius=0.0):
+        """ Returns the cells an agent of the radius can stand on as a bool array [y][x] """
+        if radius > 0.0:
+            return self.clearance >= radius / self.node_size + 0.5
+        return np.unpackbits(self.walk, axis=1)[:, :self.size].astype(bool)
+
+    def getClearance(self, x, y):
+        """ Returns the distance from the center of the cell to the closest blocked cell in world units """
+        return float(self.clearance[y, x]) * self.node_size
+
+    def getRegion(self, x, y):
+        """ Returns the region of a cell, cells with the same region are connected, 0 is not walkable """
+        if 0 <= x < self.size and 0 <= y < self.size:
+            return int(self.regions[y, x])
+        return 0
+
+    def isReachable(self, start, goal):
+        """ Returns True if there is a path between the (x, y) cells """
+        region = self.getRegion(*start)
+        return region != 0 and region == self.getRegion(*goal)
+
+    def getNeighbors(self, x, y):
+        """ Returns the (x, y) of the neighbors of a cell that can be walked on, in NEIGHBORS order """
+        links = int(self.links[y, x])
+        return [(x + dx, y + dy) for i, (dx, dy) in enumerate(NEIGHBORS) if links & (1 << i)]
+
+    def getCell(self, pos):
+        """ Returns the (x, y) of the cell under a world position """
+        return (min(self.size - 1, max(0, int(pos[0] / self.node_size))),
+                min(self.size - 1, max(0, int(pos[1] / self.node_size))))
+
+    def getCellPos(self, x, y):
+        """ Returns the world position of the center of a cell, the PosX, PosY of the CSV """
+        return (x * self.node_size + self.node_size / 2, y * self.node_size + self.node_size / 2)
+
+
+def _MoveBytes(file, start, end, shift, chunk_size=1 << 20):
+    """ Moves the bytes of the file from start to end by shift bytes """
+    if shift > 0:
+        position = end
+        while position > start:
+            size = min(chunk_size, position - start)
+            position -= size
+            file.seek(position)
+            data = file.read(size)
+            file.seek(position + shift)
+            file.write(data)
+    elif shift < 0:
+        position = start
+        while position < end:
+            size = min(chunk_size, end - position)
+            file.seek(position)
+            data = file.read(size)
+            file.seek(position + shift)
+            file.write(data)
+            position += size
+
+
+class NavmeshUpdater:
+    """
+    Keeps the walk grid, regions, clearance and CSV row sizes of the last navmesh it wrote,
+    so the next update() only has to redo the cells around the part of the walkmap that
+    changed: the grid rows of the CSV are written again in place (the rest of the file is moved
+    if their size changed) and the sections of the binary navmesh are patched through a writable
+    NavGrid. If the files were changed by something else, everything is written again.
+    """
+
+    def __init__(self, world_map_size=512.0):
+        self.world_map_size = world_map_size
+        self.reset()
+
+    def reset(self):
+        self.walkable = None
+        self.regions = None
+        self.clearance = None
+        self.csv = None
+        self.binary = None
+        self.header_bytes = 0
+        self.row_bytes = None
+        self.stamps = {}
+
+    def _stamp(self, filename):
+        if not filename:
+            return None
+        try:
+            stat = os.stat(Filename(filename).toOsSpecific())
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime
+
+    def _changedRect(self, old, walkable, rect):
+        """ Returns the part of rect where walkable is not the same as old, an empty rect if it's all the same """
+        x0, y0, x1, y1 = rect
+        ys, xs = np.nonzero(old[y0:y1, x0:x1] != walkable[y0:y1, x0:x1])
+        if not len(ys):
+            return x0, y0, x0, y0
+        return x0 + int(xs.min()), y0 + int(ys.min()), x0 + int(xs.max()) + 1, y0 + int(ys.max()) + 1
+
+    def update(self, map, csv=None, binary=None, rect=None, progress=None):
+        """ Writes or patches the CSV and/or binary navmesh of the walkmap (a PNMImage),
+        rect (x0, y0, x1, y1) is the part of the walkmap that may have changed, None if that's not known
+        (all of it is written) and an empty rect if nothing changed (the files are only checked) """
+        walkable = GetWalkable(SquareMap(map))
+        map_size = walkable.shape[0]
+        old = self.walkable
+        # not valid until it's done, a job that was cancelled leaves it empty
+        self.walkable = None
+        if (rect is not None and old is not None and old.shape == walkable.shape and
+                (csv, binary) == (self.csv, self.binary) and
+                all(self._stamp(filename) == self.stamps.get(filename) for filename in (csv, binary) if filename)):
+            rect = self._changedRect(old, walkable, rect)
+            area = max(0, rect[2] - rect[0]) * max(0, rect[3] - rect[1])
+            if 0 < area and area * 4 <= map_size * map_size:
+                if csv:
+                    self._patchCSV(csv, walkable, rect, progress)
+                if binary:
+                    self._patchBinary(binary, walkable, rect)
+            elif area:
+                self._write(csv, binary, walkable, progress)
+        else:
+            self._write(csv, binary, walkable, progress)
+        self.csv, self.binary = csv, binary
+        self.stamps = {filename: self._stamp(filename) for filename in (csv, binary) if filename}
+        self.walkable = walkable
+
+    def _write(self, csv, binary, walkable, progress):
+        if binary:
+            self.regions = GetRegions(walkable)
+            self.clearance = GetClearance(walkable)
+            WriteNavGrid(binary, walkable, self.world_map_size,
+                         [(b'REGN', self.regions), (b'CLRC', self.clearance)])
+        if csv:
+            self.header_bytes, self.row_bytes = WriteNavmeshCSV(csv, walkable, self.world_map_size, progress)
+
+    def _patchCSV(self, csv, walkable, rect, progress):
+        """ Writes the grid rows around rect again, the cells of the rows next to it list them as neighbors """
+        y0, y1 = max(0, rect[1] - 1), min(walkable.shape[0], rect[3] + 1)
+        rows = list(NavmeshRows(walkable, self.world_map_size, progress, y0, y1))
+        data = ''.join(rows).replace('\n', os.linesep).encode('ascii')
+        start = self.header_bytes + int(self.row_bytes[:y0].sum())
+        old_end = start + int(self.row_bytes[y0:y1].sum())
+        end = self.header_bytes + int(self.row_bytes.sum())
+        shift = len(data) - (old_end - start)
+        with open(csv, 'r+b') as output_file:
+            _MoveBytes(output_file, old_end, end, shift)
+            output_file.seek(start)
+            output_file.write(data)
+        if shift < 0:
+            os.truncate(Filename(csv).toOsSpecific(), end + shift)
+        self.row_bytes[y0:y1] = [_TextBytes(row) for row in rows]
+
+    def _patchBinary(self, binary, walkable, rect):
+        map_size = walkable.shape[0]
+        grid = NavGrid(binary, writable=True)
+        if grid.size != map_size or grid.section('REGN') is None or grid.section('CLRC') is None:
+            del grid
+            self._write(None, binary, walkable, None)
+            return
+        x0, y0, x1, y1 = rect
+        grid.walk[y0:y1] = np.packbits(walkable[y0:y1], axis=1)
+        # the links of the cells next to the rect change too, they need the cells next to them
+        lx0, ly0, lx1, ly1 = max(0, x0 - 1), max(0, y0 - 1), min(map_size, x1 + 1), min(map_size, y1 + 1)
+        ex0, ey0, ex1, ey1 = max(0, x0 - 2), max(0, y0 - 2), min(map_size, x1 + 2), min(map_size, y1 + 2)
+        links = GetLinks(walkable[ey0:ey1, ex0:ex1])
+        grid.links[ly0:ly1, lx0:lx1] = links[ly0 - ey0:ly1 - ey0, lx0 - ex0:lx1 - ex0]
+        bx0, by0, bx1, by1 = UpdateRegions(self.regions, walkable, rect)
+        grid.regions[by0:by1, bx0:bx1] = self.regions[by0:by1, bx0:bx1]
+        bx0, by0, bx1, by1 = UpdateClearance(self.clearance, walkable, rect)
+        grid.clearance[by0:by1, bx0:bx1] = self.clearance[by0:by1, bx0:bx1]
+        grid.data.flush()
+        del grid
 
 
 # test
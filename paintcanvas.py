@@ -0,0 +1,68 @@
+import numpy as np
+import math
+
+MAX_STAMPS = 256  # most stamps drawn between two points of a stroke
+
+
+def BrushRect(pos, heading, brush_size, canvas_size, clip=True):
+    """ Returns the pixels (x0, y0, x1, y1) of a canvas_size canvas under the brush at pos (world units,
+    the canvases cover 0-512) turned by heading (degrees), y is counted from the bottom of the canvas,
+    same as the world y. With clip=False the rect can go past the edges of the canvas """
+    scale = canvas_size / 512.0
+    heading = math.radians(heading)
+    half = 16.0 * brush_size * (abs(math.cos(heading)) + abs(math.sin(heading))) + 1.0
+    x, y = pos[0], pos[1]
+    rect = [int(math.floor((x - half) * scale)), int(math.floor((y - half) * scale)),
+            int(math.ceil((x + half) * scale)), int(math.ceil((y + half) * scale))]
+    if clip:
+        rect = [max(0, rect[0]), max(0, rect[1]), min(canvas_size, rect[2]), min(canvas_size, rect[3])]
+    return rect
+
+
+def StampPoints(start, end, brush_size, spacing):
+    """ Returns the points where the brush is stamped between start and end (without them) as a float32
+    array, spacing brush sizes apart but never more than MAX_STAMPS of them """
+    start = np.array(start, dtype=np.float32)
+    end = np.array(end, dtype=np.float32)
+    length = float(np.linalg.norm(end - start))
+    step = max(32.0 * brush_size * spacing, length / MAX_STAMPS)
+    count = int(math.ceil(length / step)) - 1
+    if count < 1:
+        return np.zeros((0, len(start)), dtype=np.float32)
+    t = (np.arange(1, count + 1, dtype=np.float32) * np.float32(step / length))[:, None]
+    return start[None, :] * (1.0 - t) + end[None, :] * t
+
+
+class CanvasDirty:
+    """
+    Keeps the changed part of each canvas for each consumer (the collision, the navmesh etc.),
+    needs self.dirty (for each canvas a dict) and self.buffSize (the size of each canvas).
+    """
+
+    def markDirty(self, id, rect=None, consumer=None):
+        """ Marks a part of canvas id as changed for all consumers (or just one), rect=None marks all of it
+        and an empty rect nothing """
+        if rect is None:
+            rect = [0, 0, self.buffSize[id], self.buffSize[id]]
+        if rect[0] >= rect[2] or rect[1] >= rect[3]:
+            return
+        for name, dirty in self.dirty[id].items():
+            if consumer is not None and name != consumer:
+                continue
+            if dirty:
+                dirty[:] = [min(dirty[0], rect[0]), min(dirty[1], rect[1]),
+                            max(dirty[2], rect[2]), max(dirty[3], rect[3])]
+            else:
+                dirty[:] = rect
+
+    def popDirty(self, id, consumer):
+        """ Returns the pixels of canvas id changed since the last call with the same consumer
+        (x0, y0, x1, y1) or None if nothing changed, the first call returns the whole canvas """
+        if consumer not in self.dirty[id]:
+            self.dirty[id][consumer] = []
+            return (0, 0, self.buffSize[id], self.buffSize[id])
+        dirty = self.dirty[id][consumer]
+        self.dirty[id][consumer] = []
+        if dirty:
+            return tuple(dirty)
+        return None
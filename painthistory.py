@@ -0,0 +1,78 @@
+import numpy as np
+import zlib
+
+TILE_SIZE = 64
+
+
+def GetTiles(rect, tile_size=TILE_SIZE):
+    """ Returns the (tx, ty) of the tiles a rect of pixels (x0, y0, x1, y1) is on """
+    x0, y0, x1, y1 = rect
+    return [(tx, ty) for ty in range(y0 // tile_size, (y1 - 1) // tile_size + 1)
+            for tx in range(x0 // tile_size, (x1 - 1) // tile_size + 1)]
+
+
+def TileRect(tile, size, tile_size=TILE_SIZE):
+    """ Returns the pixels (x0, y0, x1, y1) of a tile on a size x size canvas """
+    x0, y0 = tile[0] * tile_size, tile[1] * tile_size
+    return x0, y0, min(size, x0 + tile_size), min(size, y0 + tile_size)
+
+
+def PackTile(image, tile, tile_size=TILE_SIZE):
+    """ Returns the pixels of a tile of an image (array [y][x][bytes]) as zlib compressed bytes """
+    x0, y0, x1, y1 = TileRect(tile, image.shape[0], tile_size)
+    return zlib.compress(np.ascontiguousarray(image[y0:y1, x0:x1]).tobytes(), 1)
+
+
+def UnpackTile(data, image, tile, tile_size=TILE_SIZE):
+    """ Returns the pixels packed by PackTile() as an array shaped like the tile of the image """
+    x0, y0, x1, y1 = TileRect(tile, image.shape[0], tile_size)
+    return np.frombuffer(zlib.decompress(data), dtype=image.dtype).reshape((y1 - y0, x1 - x0) + image.shape[2:])
+
+
+class PaintHistory:
+    """
+    Undo and redo of the paint strokes. A step keeps only the tiles the stroke changed
+    (on each canvas it was painted on), before and after, compressed.
+    When all the steps take more than budget bytes the oldest ones are dropped.
+    """
+
+    def __init__(self, budget=64 * 2 ** 20):
+        self.budget = budget
+        self.undo_steps = []
+        self.redo_steps = []
+        self.size = 0
+
+    def clear(self):
+        self.undo_steps = []
+        self.redo_steps = []
+        self.size = 0
+
+    def _stepSize(self, step):
+        return sum(len(before) + len(after) for id, tile, before, after in step)
+
+    def push(self, step):
+        """ Adds a step, a list of (canvas id, tile, before, after) where before and after are from PackTile(),
+        the steps that could be redone are dropped """
+        for old_step in self.redo_steps:
+            self.size -= self._stepSize(old_step)
+        self.redo_steps = []
+        self.undo_steps.append(step)
+        self.size += self._stepSize(step)
+        while self.size > self.budget and self.undo_steps:
+            self.size -= self._stepSize(self.undo_steps.pop(0))
+
+    def undo(self):
+        """ Returns the tiles to put back to undo the last step [(id, tile, data)] or None """
+        if not self.undo_steps:
+            return None
+        step = self.undo_steps.pop()
+        self.redo_steps.append(step)
+        return [(id, tile, before) for id, tile, before, after in step]
+
+    def redo(self):
+        """ Returns the tiles to put back to redo the last undone step [(id, tile, data)] or None """
+        if not self.redo_steps:
+            return None
+        step = self.redo_steps.pop()
+        self.undo_steps.append(step)
+        return [(id, tile, after) for id, tile, before, after in step]
@@ -0,0 +1,836 @@
+from __future__ import print_function
+from array import array
+from direct.stdpy.file import open
+from helper import LRUCache, NEIGHBORS
+import heapq
+import json
+import math
+import numpy as np
+
+SQRT2 = math.sqrt(2.0)
+
+
+def Octile(dx, dy):
+    """ Length of the shortest 8-directional path dx, dy cells long (both >= 0) """
+    if dx < dy:
+        return (SQRT2 - 1.0) * dx + dy
+    return (SQRT2 - 1.0) * dy + dx
+
+
+class PathFinder:
+    """
+    A* with Jump Point Search over the walk grid. Diagonal moves are always allowed if the
+    cell they go to can be walked on, same as the links of the navmesh (see navmeshgen.GetLinks).
+    The grid is kept as a bytearray with a border of blocked cells and the search state
+    is in flat arrays indexed by cell, reused from one search to the next.
+    Agents with a radius (in world units) only walk on the cells with enough clearance
+    (see GetClearance). The grid and regions of each of the radii are made with the walk grid,
+    so a query costs the same for any of them. Other radii are made the first time they are
+    asked for and kept until the walk grid changes.
+    """
+
+    def __init__(self, walkable, world_size=512.0, cache_size=64, radii=()):
+        self.world_size = world_size
+        self.cache = LRUCache(cache_size)
+        self.radii = [float(radius) for radius in radii if radius > 0.0]
+        self.setWalkable(walkable)
+
+    def setWalkable(self, walkable):
+        """ Sets a new grid, a bool array walkable[y][x] with y counted from the bottom (see navmeshgen.GetWalkable) """
+        self.size_y, self.size_x = walkable.shape
+        self.stride = self.size_x + 2
+        padded = np.zeros((self.size_y + 2, self.stride), dtype=np.uint8)
+        padded[1:-1, 1:-1] = walkable
+        self.grid = bytearray(padded.tobytes())
+        count = len(self.grid)
+        self.g = array('d', [0.0]) * count
+        self.parent = array('i', [-1]) * count
+        # a cell is open/closed in the current search if its stamp is the search number
+        self.opened = array('I', [0]) * count
+        self.closed = array('I', [0]) * count
+        self.search = 0
+        # the regions of the whole walk grid, radius 0
+        self.regions = GetRegions(walkable)
+        self.clearance = None
+        self._makeLayers()
+
+    def updateWalkable(self, walkable, rect):
+        """ Sets a new grid where only the cells in rect (x0, y0, x1, y1) changed, the regions
+        and the clearance are updated around the rect """
+        x0, y0, x1, y1 = rect
+        grid, regions = self.layers[0.0]
+        cells = np.frombuffer(grid, dtype=np.uint8).reshape(-1, self.stride)
+        cells[y0 + 1:y1 + 1, x0 + 1:x1 + 1] = walkable[y0:y1, x0:x1]
+        UpdateRegions(regions, walkable, rect)
+        if self.clearance is not None:
+            UpdateClearance(self.clearance, walkable, rect)
+        self.grid, self.regions = grid, regions
+        self._makeLayers()
+
+    def _makeLayers(self):
+        """ Makes the grid and regions of the radii for the current walk grid """
+        # {radius: (grid, regions)}
+        self.layers = {0.0: (self.grid, self.regions)}
+        for radius in self.radii:
+            self._layer(radius)
+        self._layer(0.0)
+        self.cache.clear()
+
+    def getWalkable(self, radius=0.0):
+        """ Returns the cells an agent of the radius can stand on as a bool array [y][x] """
+        if self.clearance is None:
+            self.clearance = GetClearance(self.layers[0.0][1] != 0)
+        return self.clearance >= radius * self.size_x / self.world_size + 0.5
+
+    def _layer(self, radius):
+        """ Makes the grid used for the radius the one searched, returns the regions of the radius """
+        radius = float(radius)
+        if radius not in self.layers:
+            walkable = self.getWalkable(radius)
+            padded = np.zeros((self.size_y + 2, self.stride), dtype=np.uint8)
+            padded[1:-1, 1:-1] = walkable
+            self.layers[radius] = (bytearray(padded.tobytes()), GetRegions(walkable))
+        self.grid, regions = self.layers[radius]
+        return regions
+
+    def isWalkable(self, cell, radius=0.0):
+        self._layer(radius)
+        x, y = cell
+        if 0 <= x < self.size_x and 0 <= y < self.size_y:
+            return bool(self.grid[(y + 1) * self.stride + x + 1])
+        return False
+
+    def getRegion(self, cell, radius=0.0):
+        """ Returns the region (see GetRegions) of a cell, 0 if it can't be walked on """
+        regions = self._layer(radius)
+        x, y = cell
+        if 0 <= x < self.size_x and 0 <= y < self.size_y:
+            return int(regions[y, x])
+        return 0
+
+    def isReachable(self, start, goal, radius=0.0):
+        """ Returns True if there is a path from the start cell to the goal cell, without a search """
+        region = self.getRegion(start, radius)
+        return region != 0 and region == self.getRegion(goal, radius)
+
+    def getCell(self, pos):
+        """ Returns the cell under a world position """
+        return (min(self.size_x - 1, max(0, int(pos[0] * self.size_x / self.world_size))),
+                min(self.size_y - 1, max(0, int(pos[1] * self.size_y / self.world_size))))
+
+    def getCellPos(self, cell):
+        """ Returns the world position (x, y) of the center of a cell """
+        return ((cell[0] + 0.5) * self.world_size / self.size_x, (cell[1] + 0.5) * self.world_size / self.size_y)
+
+    def _cell(self, index):
+        y, x = divmod(index, self.stride)
+        return (x - 1, y - 1)
+
+    def _jumpStraight(self, i, step, side):
+        """ Jumps from i (already moved) along step, side is the offset to the cells on both sides """
+        grid = self.grid
+        goal = self.goal
+        while grid[i]:
+            if i == goal:
+                return i
+            # forced neighbors
+            if (grid[i + step + side] and not grid[i + side]) or (grid[i + step - side] and not grid[i - side]):
+                return i
+            i += step
+        return -1
+
+    def _jump(self, i, dx, dy):
+        """ Returns the jump point found going from i (already moved) in the direction dx, dy or -1 """
+        stride = self.stride
+        if not dx:
+            return self._jumpStraight(i, dy * stride, 1)
+        if not dy:
+            return self._jumpStraight(i, dx, stride)
+        grid = self.grid
+        goal = self.goal
+        step = dx + dy * stride
+        while grid[i]:
+            if i == goal:
+                return i
+            if (grid[i - dx + dy * stride] and not grid[i - dx]) or \
+                    (grid[i + dx - dy * stride] and not grid[i - dy * stride]):
+                return i
+            # a jump point straight ahead makes this one too
+            if self._jumpStraight(i + dx, dx, stride) >= 0 or self._jumpStraight(i + dy * stride, dy * stride, 1) >= 0:
+                return i
+            i += step
+        return -1
+
+    def _directions(self, i):
+        """ Returns the directions (dx, dy) worth searching from i, pruned by the way we got to i """
+        parent = self.parent[i]
+        if parent < 0:
+            return NEIGHBORS
+        grid = self.grid
+        stride = self.stride
+        x, y = self._cell(i)
+        px, py = self._cell(parent)
+        dx = (x > px) - (x < px)
+        dy = (y > py) - (y < py)
+        directions = []
+        if dx and dy:
+            directions = [(0, dy), (dx, 0), (dx, dy)]
+            if not grid[i - dx]:
+                directions.append((-dx, dy))
+            if not grid[i - dy * stride]:
+                directions.append((dx, -dy))
+        elif dx:
+            directions = [(dx, 0)]
+            if not grid[i + stride]:
+                directions.append((dx, 1))
+            if not grid[i - stride]:
+                directions.append((dx, -1))
+        else:
+            directions = [(0, dy)]
+            if not grid[i + 1]:
+                directions.append((1, dy))
+            if not grid[i - 1]:
+                directions.append((-1, dy))
+        return directions
+
+    def findPath(self, start, goal, radius=0.0):
+        """ Returns the jump points of the shortest path from the start cell to the goal cell,
+        both included, or [] if there is no path for an agent of the radius """
+        start, goal = (int(start[0]), int(start[1])), (int(goal[0]), int(goal[1]))
+        key = (start, goal, radius)
+        if key in self.cache:
+            return list(self.cache.get(key))
+        path = []
+        if self.isReachable(start, goal, radius):
+            path = self._search(start, goal)
+        self.cache.put(key, tuple(path))
+        return path
+
+    def _search(self, start, goal):
+        """ Searches the current grid (see _layer), start and goal have to be in the same region """
+        stride = self.stride
+        self.search += 1
+        search = self.search
+        g, parent, opened, closed = self.g, self.parent, self.opened, self.closed
+        start = (start[1] + 1) * stride + start[0] + 1
+        self.goal = goal_index = (goal[1] + 1) * stride + goal[0] + 1
+        gx, gy = goal
+        g[start] = 0.0
+        parent[start] = -1
+        opened[start] = search
+        heap = [(0.0, start)]
+        while heap:
+            f, i = heapq.heappop(heap)
+            if closed[i] == search:
+                continue
+            closed[i] = search
+            if i == goal_index:
+                path = []
+                while i >= 0:
+                    path.append(self._cell(i))
+                    i = parent[i]
+                path.reverse()
+                return path
+            x, y = self._cell(i)
+            for dx, dy in self._directions(i):
+                jump = self._jump(i + dx + dy * stride, dx, dy)
+                if jump < 0 or closed[jump] == search:
+                    continue
+                jy, jx = divmod(jump, stride)
+                jx -= 1
+                jy -= 1
+                new_g = g[i] + Octile(abs(jx - x), abs(jy - y))
+                if opened[jump] != search or new_g < g[jump]:
+                    opened[jump] = search
+                    g[jump] = new_g
+                    parent[jump] = i
+                    heapq.heappush(heap, (new_g + Octile(abs(jx - gx), abs(jy - gy)), jump))
+        return []
+
+    def expandPath(self, path):
+        """ Returns all the cells of a path of jump points """
+        if not path:
+            return []
+        cells = [path[0]]
+        for (x0, y0), (x1, y1) in zip(path[:-1], path[1:]):
+            dx = (x1 > x0) - (x1 < x0)
+            dy = (y1 > y0) - (y1 < y0)
+            x, y = x0, y0
+            while (x, y) != (x1, y1):
+                x += dx
+                y += dy
+                cells.append((x, y))
+        return cells
+
+    def getPathLength(self, path):
+        """ Returns the length of a path of cells or jump points in world units """
+        scale = self.world_size / self.size_x
+        return sum(Octile(abs(x1 - x0), abs(y1 - y0)) for (x0, y0), (x1, y1) in zip(path[:-1], path[1:])) * scale
+
+
+def GetRegions(walkable):
+    """ Returns an int32 array with the region of each cell of the walkable array [y][x],
+    cells in the same region are 8-connected (as the links of the navmesh), regions are
+    numbered from 1 in the order they are first found (from the bottom row), 0 is not walkable.
+    Connects the horizontal runs of walkable cells with a union-find """
+    height, width = walkable.shape
+    stride = width + 2
+    padded = np.zeros((height, stride), dtype=np.int8)
+    padded[:, 1:-1] = walkable
+    edges = np.diff(padded, axis=1)
+    rows, starts = np.nonzero(edges == 1)
+    ends = np.nonzero(edges == -1)[1]
+    if not len(rows):
+        return np.zeros(walkable.shape, dtype=np.int32)
+    # the runs of the next row that touch a run (also diagonally) are a range of run indices
+    start_keys = rows * stride + starts
+    end_keys = rows * stride + ends
+    first = np.searchsorted(end_keys, start_keys + stride, 'left')
+    last = np.searchsorted(start_keys, end_keys + stride, 'right')
+    counts = np.maximum(last - first, 0)
+    run_a = np.repeat(np.arange(len(rows)), counts)
+    run_b = np.repeat(first - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+    parent = list(range(len(rows)))
+    for a, b in zip(run_a.tolist(), run_b.tolist()):
+        while parent[a] != a:
+            parent[a] = a = parent[parent[a]]
+        while parent[b] != b:
+            parent[b] = b = parent[parent[b]]
+        # the root is the first run of the region
+        if a < b:
+            parent[b] = a
+        elif b < a:
+            parent[a] = b
+    roots = np.array(parent)
+    while True:
+        next_roots = roots[roots]
+        if np.array_equal(next_roots, roots):
+            break
+        roots = next_roots
+    labels = np.unique(roots, return_inverse=True)[1].astype(np.int32) + 1
+    # label the runs: +label at the start, -label at the end, summed along the rows
+    regions = np.zeros((height, width + 1), dtype=np.int32)
+    np.add.at(regions, (rows, starts), labels)
+    np.add.at(regions, (rows, ends), -labels)
+    return np.cumsum(regions, axis=1)[:, :-1]
+
+
+def GetClearance(walkable):
+    """ Returns a float32 array with the distance (in cells, center to center) from each cell
+    of the walkable array [y][x] to the closest cell that can't be walked on, the cells out
+    of the map can't be walked on either, so the cells at the edge are 1.0 and blocked cells 0.0.
+    An exact Euclidean distance transform: the distances down the columns and then the lower
+    envelope of parabolas along the rows (Felzenszwalb & Huttenlocher), all rows at once """
+    height, width = walkable.shape
+    blocked = np.ones((height + 2, width + 2), dtype=bool)
+    blocked[1:-1, 1:-1] = ~walkable
+    # distance to the closest blocked cell in the same column
+    y = np.arange(height + 2)[:, None]
+    above = np.maximum.accumulate(np.where(blocked, y, -1), axis=0)
+    below = np.flipud(np.minimum.accumulate(np.flipud(np.where(blocked, y, height + 2)), axis=0))
+    f = (np.minimum(y - above, below - y)[1:-1].astype(np.float64)) ** 2
+    # the rows, each cell is a parabola (x - q)^2 + f[q], the lowest one wins
+    rows = np.arange(height)
+    size = width + 2
+    q2 = np.arange(size, dtype=np.float64) ** 2
+    k = np.zeros(height, dtype=np.intp)
+    v = np.zeros((height, size), dtype=np.intp)
+    z = np.full((height, size + 1), np.inf)
+    z[:, 0] = -np.inf
+    for q in range(1, size):
+        fq = f[:, q] + q2[q]
+        while True:
+            vk = v[rows, k]
+            s = (fq - f[rows, vk] - q2[vk]) / (2 * (q - vk))
+            pop = s <= z[rows, k]
+            if not pop.any():
+                break
+            k -= pop
+        k += 1
+        v[rows, k] = q
+        z[rows, k] = s
+        z[rows, k + 1] = np.inf
+    distance = np.empty((height, size))
+    k[:] = 0
+    for q in range(size):
+        while True:
+            step = z[rows, k + 1] < q
+            if not step.any():
+                break
+            k += step
+        vk = v[rows, k]
+        distance[:, q] = (q - vk) ** 2 + f[rows, vk]
+    return np.sqrt(distance[:, 1:-1]).astype(np.float32)
+
+
+def UpdateRegions(regions, walkable, rect):
+    """ Updates the regions (see GetRegions) in place after the cells of walkable in rect
+    (x0, y0, x1, y1) changed, only the regions next to the rect are labelled again.
+    The labels are not in the order GetRegions gives them, but two cells still have the same
+    label only if they are connected. Returns the changed part of the array (x0, y0, x1, y1) """
+    x0, y0, x1, y1 = rect
+    ring = regions[max(0, y0 - 1):y1 + 1, max(0, x0 - 1):x1 + 1]
+    touched = np.unique(ring[ring > 0])
+    mask = np.isin(regions, touched)
+    mask[y0:y1, x0:x1] = True
+    mask &= walkable
+    top = int(regions.max())
+    regions[y0:y1, x0:x1] = 0
+    ys, xs = np.nonzero(mask)
+    if not len(ys):
+        return rect
+    bx0, by0, bx1, by1 = int(xs.min()), int(ys.min()), int(xs.max()) + 1, int(ys.max()) + 1
+    box = mask[by0:by1, bx0:bx1]
+    labels = GetRegions(box)
+    # the old labels are used again, then new ones
+    count = int(labels.max())
+    fresh = np.arange(top + 1, top + 1 + max(0, count - len(touched)), dtype=np.int32)
+    ids = np.concatenate([np.zeros(1, dtype=np.int32), touched.astype(np.int32), fresh])[:count + 1]
+    regions[by0:by1, bx0:bx1][box] = ids[labels[box]]
+    return min(x0, bx0), min(y0, by0), max(x1, bx1), max(y1, by1)
+
+
+def UpdateClearance(clearance, walkable, rect):
+    """ Updates the clearance (see GetClearance) in place after the cells of walkable in rect
+    (x0, y0, x1, y1) changed. Only the cells that are as close to the rect as to their closest
+    blocked cell can change, they are done again in a box around them, grown until the box
+    edges are further away than the clearance found. Returns the changed part (x0, y0, x1, y1) """
+    height, width = walkable.shape
+    x0, y0, x1, y1 = rect
+    dx = np.maximum(np.maximum(x0 - np.arange(width), np.arange(width) - (x1 - 1)), 0)
+    dy = np.maximum(np.maximum(y0 - np.arange(height), np.arange(height) - (y1 - 1)), 0)
+    # squared distances are whole numbers, so ties are found
+    affected = dx[None, :] ** 2 + dy[:, None] ** 2 <= np.rint(clearance.astype(np.float64) ** 2)
+    affected[y0:y1, x0:x1] = True
+    ys, xs = np.nonzero(affected)
+    ax0, ay0, ax1, ay1 = int(xs.min()), int(ys.min()), int(xs.max()) + 1, int(ys.max()) + 1
+    margin = int(math.ceil(clearance[affected].max())) + 1
+    while True:
+        bx0, by0 = max(0, ax0 - margin), max(0, ay0 - margin)
+        bx1, by1 = min(width, ax1 + margin), min(height, ay1 + margin)
+        box = GetClearance(walkable[by0:by1, bx0:bx1])
+        # the box edges inside the map are taken as blocked, that's only right for cells closer
+        # to a blocked cell than to such an edge
+        edge_x = np.full(bx1 - bx0, np.inf, dtype=np.float32)
+        edge_y = np.full(by1 - by0, np.inf, dtype=np.float32)
+        if bx0 > 0:
+            edge_x = np.minimum(edge_x, np.arange(1, bx1 - bx0 + 1))
+        if bx1 < width:
+            edge_x = np.minimum(edge_x, np.arange(bx1 - bx0, 0, -1))
+        if by0 > 0:
+            edge_y = np.minimum(edge_y, np.arange(1, by1 - by0 + 1))
+        if by1 < height:
+            edge_y = np.minimum(edge_y, np.arange(by1 - by0, 0, -1))
+        edge = np.minimum(edge_x[None, :], edge_y[:, None])
+        inner = affected[by0:by1, bx0:bx1]
+        if (box[inner] < edge[inner]).all() or (bx0, by0, bx1, by1) == (0, 0, width, height):
+            break
+        margin *= 2
+    clearance[by0:by1, bx0:bx1][inner] = box[inner]
+    return ax0, ay0, ax1, ay1
+
+
+def ClusterDistances(walkable, sources):
+    """ Returns the 8-connected path lengths from each source to every cell of its own grid,
+    walkable is a (n, h, w) bool array, sources n (x, y) cells. All the grids are relaxed
+    at once with array shifts until nothing gets shorter, unreachable cells are inf """
+    count, height, width = walkable.shape
+    dist = np.full((count, height + 2, width + 2), np.inf, dtype=np.float32)
+    sources = np.asarray(sources).reshape(-1, 2)
+    dist[np.arange(count), sources[:, 1] + 1, sources[:, 0] + 1] = 0.0
+    inner = dist[:, 1:-1, 1:-1]
+    blocked = ~walkable
+    steps = [(dx, dy, np.float32(SQRT2 if dx and dy else 1.0)) for dx, dy in NEIGHBORS]
+    while True:
+        best = inner.copy()
+        for dx, dy, cost in steps:
+            np.minimum(best, dist[:, 1 + dy:1 + dy + height, 1 + dx:1 + dx + width] + cost, out=best)
+        best[blocked] = np.inf
+        if np.array_equal(best, inner):
+            return best
+        inner[...] = best
+
+
+class ClusterGraph:
+    """
+    HPA* (hierarchical path finding): the walk grid is cut into clusters, cells on both sides of
+    the cluster borders are entrance nodes, linked to the nodes of the same cluster by their
+    path length inside the cluster. A query searches the small graph of the nodes and then
+    finds the path between each two nodes on the grid, only a short way each.
+    """
+
+    def __init__(self, size_x=0, size_y=0, cluster_size=16):
+        self.size_x = size_x
+        self.size_y = size_y
+        self.cluster_size = cluster_size
+        self.nodes = []  # (x, y) of the entrance cells
+        self.links = []  # for each node [(other node, cost), ...]
+        self.cluster_nodes = {}  # {(cx, cy): [nodes]}
+
+    def getCluster(self, cell):
+        return (cell[0] // self.cluster_size, cell[1] // self.cluster_size)
+
+    def _addNode(self, cell, ids):
+        if cell not in ids:
+            ids[cell] = len(self.nodes)
+            self.nodes.append(cell)
+            self.links.append([])
+            self.cluster_nodes.setdefault(self.getCluster(cell), []).append(ids[cell])
+        return ids[cell]
+
+    def _addLink(self, a, b, cost):
+        self.links[a].append((b, cost))
+        self.links[b].append((a, cost))
+
+    def _clusterGrid(self, walkable, cluster):
+        """ Returns the cells of one cluster as a (cluster_size, cluster_size) array, padded with
+        blocked cells at the edge of the map, and the first cell of the cluster """
+        size = self.cluster_size
+        x0, y0 = cluster[0] * size, cluster[1] * size
+        grid = np.zeros((size, size), dtype=bool)
+        part = walkable[y0:y0 + size, x0:x0 + size]
+        grid[:part.shape[0], :part.shape[1]] = part
+        return grid, x0, y0
+
+    def build(self, walkable, max_entrance=6):
+        """ Finds the entrances and the links of a bool walkable[y][x] array. Runs of cells along a border
+        that are walkable on both sides get one node pair in the middle, or one at each end if they
+        are max_entrance or more cells long. A diagonal step between clusters where both cells next
+        to it are blocked gets its own node pair """
+        self.size_y, self.size_x = walkable.shape
+        self.nodes, self.links, self.cluster_nodes = [], [], {}
+        size = self.cluster_size
+        ids = {}
+        # borders between columns x - 1 and x, then between rows y - 1 and y (as columns of walkable.T)
+        for grid, flip in ((walkable, False), (walkable.T, True)):
+            for x in range(size, grid.shape[1], size):
+                passable = grid[:, x - 1] & grid[:, x]
+                for y0 in range(0, grid.shape[0], size):
+                    part = np.concatenate([[False], passable[y0:y0 + size], [False]])
+                    edges = np.flatnonzero(part[1:] != part[:-1])
+                    for start, end in zip((edges[::2] + y0).tolist(), (edges[1::2] + y0).tolist()):
+                        crossings = [(start + end - 1) // 2]
+                        if end - start >= max_entrance:
+                            crossings = [start, end - 1]
+                        for y in crossings:
+                            a, b = ((x - 1, y), (x, y)) if not flip else ((y, x - 1), (y, x))
+                            self._addLink(self._addNode(a, ids), self._addNode(b, ids), 1.0)
+        # diagonal squeezes (both cells between them blocked)
+        for dy, mask in ((1, walkable[:-1, :-1] & walkable[1:, 1:] & ~walkable[:-1, 1:] & ~walkable[1:, :-1]),
+                         (-1, walkable[1:, :-1] & walkable[:-1, 1:] & ~walkable[:-1, :-1] & ~walkable[1:, 1:])):
+            for y, x in zip(*np.nonzero(mask)):
+                a = (int(x), int(y) if dy > 0 else int(y) + 1)
+                b = (a[0] + 1, a[1] + dy)
+                if self.getCluster(a) != self.getCluster(b):
+                    self._addLink(self._addNode(a, ids), self._addNode(b, ids), SQRT2)
+        # path lengths between the nodes of each cluster, a batch of clusters at a time
+        clusters = sorted(self.cluster_nodes)
+        batch = max(1, 65536 // (size * size))
+        sources, grids = [], []
+        for cluster in clusters:
+            grid, x0, y0 = self._clusterGrid(walkable, cluster)
+            for node in self.cluster_nodes[cluster]:
+                grids.append(grid)
+                sources.append((self.nodes[node][0] - x0, self.nodes[node][1] - y0))
+        dist = np.concatenate([ClusterDistances(np.array(grids[i:i + batch]), sources[i:i + batch])
+                               for i in range(0, len(grids), batch)]) if grids else []
+        i = 0
+        for cluster in clusters:
+            nodes = self.cluster_nodes[cluster]
+            x0, y0 = cluster[0] * size, cluster[1] * size
+            for n, a in enumerate(nodes):
+                for b in nodes[n + 1:]:
+                    cost = dist[i + n][self.nodes[b][1] - y0, self.nodes[b][0] - x0]
+                    if np.isfinite(cost):
+                        self._addLink(a, b, float(cost))
+            i += len(nodes)
+        return self
+
+    def write(self, output):
+        """ Writes the graph as json, the links are [a, b, cost] with a < b """
+        links = [[a, b, round(cost, 4)] for a in range(len(self.links)) for b, cost in self.links[a] if a < b]
+        with open(output, 'w') as output_file:
+            json.dump({'size': [self.size_x, self.size_y],
+                       'cluster_size': self.cluster_size,
+                       'nodes': self.nodes,
+                       'links': links}, output_file)
+
+    def load(self, filename):
+        with open(filename) as input_file:
+            data = json.load(input_file)
+        self.size_x, self.size_y = data['size']
+        self.cluster_size = data['cluster_size']
+        self.nodes, self.links, self.cluster_nodes = [], [], {}
+        ids = {}
+        for x, y in data['nodes']:
+            self._addNode((x, y), ids)
+        for a, b, cost in data['links']:
+            self._addLink(a, b, cost)
+        return self
+
+    def _localLinks(self, grid, cell):
+        """ Returns [(node, cost)] of the nodes reachable from cell inside its cluster """
+        cluster = self.getCluster(cell)
+        cluster_grid, x0, y0 = self._clusterGrid(grid, cluster)
+        dist = ClusterDistances(cluster_grid[None], [(cell[0] - x0, cell[1] - y0)])[0]
+        links = []
+        for node in self.cluster_nodes.get(cluster, []):
+            cost = dist[self.nodes[node][1] - y0, self.nodes[node][0] - x0]
+            if np.isfinite(cost):
+                links.append((node, float(cost)))
+        return links
+
+    def _localPath(self, grid, finders, a, b):
+        """ Returns the jump points of the path from a to b inside the cluster of a """
+        cluster = self.getCluster(a)
+        if cluster not in finders:
+            cluster_grid, x0, y0 = self._clusterGrid(grid, cluster)
+            finders[cluster] = PathFinder(cluster_grid, cache_size=0)
+        x0, y0 = cluster[0] * self.cluster_size, cluster[1] * self.cluster_size
+        path = finders[cluster].findPath((a[0] - x0, a[1] - y0), (b[0] - x0, b[1] - y0))
+        return [(x + x0, y + y0) for x, y in path]
+
+    def findPath(self, path_finder, start, goal):
+        """ Returns the jump points of a path from the start cell to the goal cell ([] if there is none),
+        path_finder is a PathFinder of the same walk grid. The path is not always the shortest one,
+        but close, the grid is only searched inside the clusters the path goes through.
+        The entrances are those of the whole walk grid, so there is no agent radius here
+        (PathFinder.findPath() takes one) """
+        start, goal = (int(start[0]), int(start[1])), (int(goal[0]), int(goal[1]))
+        if not path_finder.isReachable(start, goal):
+            return []
+        grid = path_finder.layers[0.0][0]
+        grid = np.frombuffer(grid, dtype=np.uint8).reshape(-1, path_finder.stride)[1:-1, 1:-1] != 0
+        finders = {}
+        if self.getCluster(start) == self.getCluster(goal):
+            path = self._localPath(grid, finders, start, goal)
+            if path:
+                return path
+        # start and goal are added to the graph as nodes -1 and -2 for this search
+        start_links = self._localLinks(grid, start)
+        goal_links = dict(self._localLinks(grid, goal))
+        cells = {-1: start, -2: goal}
+        g = {-1: 0.0}
+        parent = {-1: None}
+        closed = set()
+        heap = [(0.0, -1)]
+        while heap:
+            f, node = heapq.heappop(heap)
+            if node in closed:
+                continue
+            closed.add(node)
+            if node == -2:
+                break
+            links = start_links if node == -1 else self.links[node]
+            if node in goal_links:
+                links = links + [(-2, goal_links[node])]
+            for other, cost in links:
+                new_g = g[node] + cost
+                if other not in closed and new_g < g.get(other, float('inf')):
+                    g[other] = new_g
+                    parent[other] = node
+                    x, y = cells[other] if other < 0 else self.nodes[other]
+                    heapq.heappush(heap, (new_g + Octile(abs(x - goal[0]), abs(y - goal[1])), other))
+        if -2 not in closed:
+            return []
+        nodes = []
+        node = -2
+        while node is not None:
+            nodes.append(cells[node] if node < 0 else self.nodes[node])
+            node = parent[node]
+        nodes.reverse()
+        # refine, each part is a short search inside one cluster or a step to the next one
+        path = [start]
+        for a, b in zip(nodes[:-1], nodes[1:]):
+            if self.getCluster(a) != self.getCluster(b):
+                path.append(b)
+            elif a != b:
+                path += self._localPath(grid, finders, a, b)[1:]
+        return path
+
+
+def GetRectangles(walkable):
+    """ Returns the walkable array [y][x] merged into rectangles as an (n, 4) int array of
+    x0, y0, x1, y1 (in cells, x1 and y1 not included) and an int32 array with the rectangle
+    of each cell (-1 if it can't be walked on). Greedy: each run of free cells in a row
+    (from the bottom) is grown up as far as the whole run stays free """
+    height, width = walkable.shape
+    free = walkable.copy()
+    ids = np.full(walkable.shape, -1, dtype=np.int32)
+    rectangles = []
+    padded = np.zeros(width + 2, dtype=np.int8)
+    for y in range(height):
+        padded[1:-1] = free[y]
+        edges = np.diff(padded)
+        for x0, x1 in zip(np.flatnonzero(edges == 1).tolist(), np.flatnonzero(edges == -1).tolist()):
+            y1 = y + 1
+            while y1 < height and free[y1, x0:x1].all():
+                y1 += 1
+            free[y:y1, x0:x1] = False
+            ids[y:y1, x0:x1] = len(rectangles)
+            rectangles.append((x0, y, x1, y1))
+    return np.array(rectangles, dtype=np.int32).reshape(-1, 4), ids
+
+
+def _TriArea2(a, b, c):
+    return (c[0] - a[0]) * (b[1] - a[1]) - (b[0] - a[0]) * (c[1] - a[1])
+
+
+class PolygonGraph:
+    """
+    The walk grid merged into rectangles (convex polygons) linked by portals, the parts of the
+    rectangle borders they share (a point if they only touch at a corner, diagonal moves are
+    allowed as in the navmesh). A search goes over the rectangles and the path is pulled tight
+    through the portals (funnel algorithm). Points are in cells, the center of cell (x, y)
+    is (x + 0.5, y + 0.5).
+    """
+
+    def __init__(self):
+        self.size_x = 0
+        self.size_y = 0
+        self.polygons = np.zeros((0, 4), dtype=np.int32)
+        self.links = []  # for each polygon [(other polygon, portal x0, y0, x1, y1), ...]
+        self.ids = None
+
+    def build(self, walkable):
+        """ Merges the cells of a walkable array [y][x] into polygons and links them """
+        self.size_y, self.size_x = walkable.shape
+        self.polygons, self.ids = GetRectangles(walkable)
+        # pairs of polygons with cells next to each other (8-connected)
+        pairs = []
+        for a, b in ((self.ids[:, :-1], self.ids[:, 1:]), (self.ids[:-1], self.ids[1:]),
+                     (self.ids[:-1, :-1], self.ids[1:, 1:]), (self.ids[:-1, 1:], self.ids[1:, :-1])):
+            linked = (a >= 0) & (b >= 0) & (a != b)
+            pairs.append(np.stack([np.minimum(a[linked], b[linked]), np.maximum(a[linked], b[linked])], axis=1))
+        pairs = np.unique(np.concatenate(pairs), axis=0)
+        self._setLinks(pairs)
+        return self
+
+    def _setLinks(self, pairs):
+        # the rectangles only touch, so where they overlap is the portal
+        a, b = self.polygons[pairs[:, 0]], self.polygons[pairs[:, 1]]
+        portals = np.concatenate([np.maximum(a[:, :2], b[:, :2]), np.minimum(a[:, 2:], b[:, 2:])], axis=1)
+        self.links = [[] for i in range(len(self.polygons))]
+        for (a, b), portal in zip(pairs.tolist(), portals.tolist()):
+            self.links[a].append((b,) + tuple(portal))
+            self.links[b].append((a,) + tuple(portal))
+
+    def write(self, output):
+        """ Writes the graph as json, polygons are [x0, y0, x1, y1] and links [a, b] with a < b """
+        links = [[a, link[0]] for a in range(len(self.links)) for link in self.links[a] if a < link[0]]
+        with open(output, 'w') as output_file:
+            json.dump({'size': [self.size_x, self.size_y],
+                       'polygons': self.polygons.tolist(),
+                       'links': links}, output_file)
+
+    def load(self, filename):
+        with open(filename) as input_file:
+            data = json.load(input_file)
+        self.size_x, self.size_y = data['size']
+        self.polygons = np.array(data['polygons'], dtype=np.int32).reshape(-1, 4)
+        self.ids = np.full((self.size_y, self.size_x), -1, dtype=np.int32)
+        for i, (x0, y0, x1, y1) in enumerate(self.polygons.tolist()):
+            self.ids[y0:y1, x0:x1] = i
+        self._setLinks(np.array(data['links'], dtype=np.intp).reshape(-1, 2))
+        return self
+
+    def getPolygon(self, cell):
+        """ Returns the polygon of a cell, -1 if it can't be walked on """
+        x, y = cell
+        if 0 <= x < self.size_x and 0 <= y < self.size_y:
+            return int(self.ids[y, x])
+        return -1
+
+    def findCorridor(self, start, goal):
+        """ Returns the polygons from the polygon of the start cell to that of the goal cell and
+        the portals between them, ([], []) if there is no path """
+        first, last = self.getPolygon(start), self.getPolygon(goal)
+        if first < 0 or last < 0:
+            return [], []
+        goal_point = (goal[0] + 0.5, goal[1] + 0.5)
+        # the cost of a polygon is the length to the point of the portal it was entered by,
+        # the closest one to where the polygon before was entered
+        points = {first: (start[0] + 0.5, start[1] + 0.5)}
+        g = {first: 0.0}
+        parent = {first: None}
+        closed = set()
+        heap = [(0.0, first)]
+        while heap:
+            f, polygon = heapq.heappop(heap)
+            if polygon in closed:
+                continue
+            closed.add(polygon)
+            if polygon == last:
+                break
+            x, y = points[polygon]
+            for other, x0, y0, x1, y1 in self.links[polygon]:
+                if other in closed:
+                    continue
+                point = (min(x1, max(x0, x)), min(y1, max(y0, y)))
+                new_g = g[polygon] + math.hypot(point[0] - x, point[1] - y)
+                if new_g < g.get(other, float('inf')):
+                    g[other] = new_g
+                    points[other] = point
+                    parent[other] = (polygon, (x0, y0, x1, y1))
+                    heapq.heappush(heap, (new_g + math.hypot(goal_point[0] - point[0], goal_point[1] - point[1]),
+                                          other))
+        if last not in closed:
+            return [], []
+        polygons, portals = [last], []
+        while parent[polygons[-1]] is not None:
+            polygon, portal = parent[polygons[-1]]
+            polygons.append(polygon)
+            portals.append(portal)
+        polygons.reverse()
+        portals.reverse()
+        return polygons, portals
+
+    def findPath(self, start, goal):
+        """ Returns the corner points of a path from the center of the start cell to the center
+        of the goal cell, [] if there is no path. The polygons cover the whole walk grid, so there
+        is no agent radius here (PathFinder.findPath() takes one) """
+        polygons, portals = self.findCorridor(start, goal)
+        if not polygons:
+            return []
+        start = (start[0] + 0.5, start[1] + 0.5)
+        goal = (goal[0] + 0.5, goal[1] + 0.5)
+        # the ends of each portal as (left, right) looking from the polygon before it
+        sides = [(start, start)]
+        for polygon, (x0, y0, x1, y1) in zip(polygons, portals):
+            px0, py0, px1, py1 = self.polygons[polygon].tolist()
+            dx = (x0 + x1) - (px0 + px1)
+            dy = (y0 + y1) - (py0 + py1)
+            if dx * (y1 - y0) - dy * (x1 - x0) > 0:
+                sides.append(((x1, y1), (x0, y0)))
+            else:
+                sides.append(((x0, y0), (x1, y1)))
+        sides.append((goal, goal))
+        # simple stupid funnel
+        path = [start]
+        apex = left = right = start
+        apex_index = left_index = right_index = 0
+        i = 1
+        while i < len(sides):
+            new_left, new_right = sides[i]
+            if _TriArea2(apex, right, new_right) <= 0.0:
+                if apex == right or _TriArea2(apex, left, new_right) > 0.0:
+                    right, right_index = new_right, i
+                else:
+                    path.append(left)
+                    apex = right = left
+                    apex_index = right_index = left_index
+                    i = apex_index + 1
+                    continue
+            if _TriArea2(apex, left, new_left) >= 0.0:
+                if apex == left or _TriArea2(apex, right, new_left) < 0.0:
+                    left, left_index = new_left, i
+                else:
+                    path.append(right)
+                    apex = left = right
+                    apex_index = left_index = right_index
+                    i = apex_index + 1
+                    continue
+            i += 1
+        if path[-1] != goal:
+            path.append(goal)
+        return path
@@ -0,0 +1,169 @@
+from panda3d.core import *
+from collisiongen import SampleHeights
+from helper import MASK_WATER, MASK_SHADOW, NEIGHBORS
+import colorsys
+import numpy as np
+
+
+class WalkOverlay:
+    """
+    Draws helpers (like test paths) over the terrain in walk mode, the lines follow
+    the heightmap so they are not hidden by hills.
+    """
+
+    def __init__(self, world_size=512.0, offset=1.0):
+        self.world_size = world_size
+        self.offset = offset
+        self.heights = None
+        self.scale = 100.0
+        self.root = render.attachNewNode('walk_overlay')
+        self.root.setLightOff()
+        self.root.setTextureOff(1)
+        self.root.setShaderOff(1)
+        self.root.hide(MASK_WATER)
+        self.root.hide(MASK_SHADOW)
+        self.regions = None
+        self.flow = None
+
+    def setHeights(self, heights, scale):
+        """ heights are the GetHeights() of the heightmap """
+        self.heights = heights
+        self.scale = scale
+
+    def getZ(self, x, y):
+        if self.heights is None:
+            return self.offset
+        return float(SampleHeights(self.heights, x, y, self.world_size)) * self.scale + self.offset
+
+    def _drape(self, name, resolution):
+        """ Returns a grid of resolution x resolution quads over the terrain, with uv from 0 to 1 """
+        uv = np.linspace(0.0, 1.0, resolution + 1, dtype=np.float32)
+        u, v = np.meshgrid(uv, uv)
+        x, y = u * self.world_size, v * self.world_size
+        z = np.full(x.shape, self.offset, dtype=np.float32)
+        if self.heights is not None:
+            z += SampleHeights(self.heights, x, y, self.world_size) * self.scale
+        vertex_data = GeomVertexData(name, GeomVertexFormat.getV3t2(), Geom.UHStatic)
+        vertex_data.uncleanSetNumRows(x.size)
+        rows = np.stack([x.ravel(), y.ravel(), z.ravel(), u.ravel(), v.ravel()], axis=1).astype(np.float32)
+        memoryview(vertex_data.modifyArray(0)).cast('B')[:] = rows.tobytes()
+        corner = (np.arange(resolution)[None, :] + np.arange(resolution)[:, None] * (resolution + 1)).ravel()
+        quads = np.stack([corner, corner + 1, corner + resolution + 2,
+                          corner, corner + resolution + 2, corner + resolution + 1], axis=1)
+        triangles = GeomTriangles(Geom.UHStatic)
+        triangles.setIndexType(Geom.NTUint32)
+        indices = triangles.modifyVertices()
+        indices.uncleanSetNumRows(quads.size)
+        memoryview(indices).cast('B')[:] = quads.astype(np.uint32).tobytes()
+        geom = Geom(vertex_data)
+        geom.addPrimitive(triangles)
+        node = GeomNode(name)
+        node.addGeom(geom)
+        return self.root.attachNewNode(node)
+
+    def showRegions(self, regions, alpha=0.5, resolution=256):
+        """ Colours the islands of the walkmap over the terrain, regions is an array of cell regions
+        (see pathfinder.GetRegions). The biggest region and the cells that can't be walked on are left
+        clear, every other region (cut off from the biggest one) gets a colour of its own """
+        self.hideRegions()
+        sizes = np.bincount(regions.ravel())
+        sizes[0] = 0
+        colors = np.zeros((len(sizes), 4), dtype=np.uint8)
+        for region in range(1, len(sizes)):
+            # golden ratio hues, so regions next to each other have different colours
+            r, g, b = colorsys.hsv_to_rgb((region * 0.618034) % 1.0, 0.8, 1.0)
+            colors[region] = (b * 255, g * 255, r * 255, alpha * 255)
+        colors[np.argmax(sizes)] = 0
+        size_y, size_x = regions.shape
+        tex = Texture('regions')
+        tex.setup2dTexture(size_x, size_y, Texture.TUnsignedByte, Texture.FRgba8)
+        # the rows of the regions and of a ram image both start at the bottom
+        tex.setRamImage(colors[regions].tobytes())
+        tex.setMagfilter(SamplerState.FTNearest)
+        tex.setMinfilter(SamplerState.FTNearest)
+        tex.setWrapU(SamplerState.WMClamp)
+        tex.setWrapV(SamplerState.WMClamp)
+        self.regions = self._drape('regions', resolution)
+        self.regions.setTexture(tex, 2)
+        self.regions.setTransparency(TransparencyAttrib.MAlpha)
+        self.regions.setDepthOffset(1)
+        self.regions.setDepthWrite(False)
+        return len(sizes) - 2 if len(sizes) > 1 else 0
+
+    def hideRegions(self):
+        if self.regions is not None:
+            self.regions.removeNode()
+            self.regions = None
+
+    def showPath(self, points, color=(1.0, 0.8, 0.0, 1.0), thickness=3.0, step=2.0):
+        """ Draws a line through the world points (x, y), split every step units to follow the terrain """
+        lines = LineSegs('path')
+        lines.setColor(*color)
+        lines.setThickness(thickness)
+        lines.moveTo(points[0][0], points[0][1], self.getZ(*points[0]))
+        for (x0, y0), (x1, y1) in zip(points[:-1], points[1:]):
+            count = max(1, int(((x1 - x0) ** 2 + (y1 - y0) ** 2) ** 0.5 / step))
+            for i in range(1, count + 1):
+                x = x0 + (x1 - x0) * i / count
+                y = y0 + (y1 - y0) * i / count
+                lines.drawTo(x, y, self.getZ(x, y))
+        return self.root.attachNewNode(lines.create())
+
+    def showMarker(self, pos, color=(1.0, 0.8, 0.0, 1.0), size=4.0):
+        """ Draws a cross at the world point (x, y) """
+        x, y = pos[0], pos[1]
+        z = self.getZ(x, y)
+        lines = LineSegs('marker')
+        lines.setColor(*color)
+        lines.setThickness(3.0)
+        lines.moveTo(x - size, y - size, z)
+        lines.drawTo(x + size, y + size, z)
+        lines.moveTo(x - size, y + size, z)
+        lines.drawTo(x + size, y - size, z)
+        lines.moveTo(x, y, z)
+        lines.drawTo(x, y, z + size * 2.0)
+        return self.root.attachNewNode(lines.create())
+
+    def showFlowField(self, directions, integration, step=4):
+        """ Draws an arrow for every step-th cell of a flow field (see flowfield.FlowField) on the terrain,
+        pointing the way to the goal, green close to the goal and red far from it """
+        self.hideFlowField()
+        size_y, size_x = directions.shape
+        cell_x, cell_y = self.world_size / size_x, self.world_size / size_y
+        ys, xs = np.mgrid[step // 2:size_y:step, step // 2:size_x:step]
+        keep = directions[ys, xs] != 255
+        ys, xs = ys[keep], xs[keep]
+        if not len(xs):
+            return
+        far = max(1.0, float(integration[ys, xs].max()))
+        neighbors = np.array(NEIGHBORS, dtype=np.float32)[directions[ys, xs]]
+        neighbors /= np.hypot(neighbors[:, 0], neighbors[:, 1])[:, None]
+        length = min(cell_x, cell_y) * step * 0.4
+        x, y = (xs + 0.5) * cell_x, (ys + 0.5) * cell_y
+        tip_x, tip_y = x + neighbors[:, 0] * length, y + neighbors[:, 1] * length
+        z = np.full(x.shape, self.offset)
+        if self.heights is not None:
+            z += SampleHeights(self.heights, x, y, self.world_size) * self.scale
+        lines = LineSegs('flow')
+        lines.setThickness(2.0)
+        for i in range(len(x)):
+            t = float(integration[ys[i], xs[i]]) / far
+            lines.setColor(t, 1.0 - t, 0.0, 1.0)
+            dx, dy = neighbors[i, 0] * length * 0.4, neighbors[i, 1] * length * 0.4
+            lines.moveTo(x[i], y[i], z[i])
+            lines.drawTo(tip_x[i], tip_y[i], z[i])
+            lines.drawTo(tip_x[i] - dx - dy * 0.6, tip_y[i] - dy + dx * 0.6, z[i])
+            lines.moveTo(tip_x[i], tip_y[i], z[i])
+            lines.drawTo(tip_x[i] - dx + dy * 0.6, tip_y[i] - dy - dx * 0.6, z[i])
+        self.flow = self.root.attachNewNode(lines.create())
+
+    def hideFlowField(self):
+        if self.flow is not None:
+            self.flow.removeNode()
+            self.flow = None
+
+    def clear(self):
+        """ Removes the paths and markers, the regions and flow field stay """
+        for child in self.root.getChildren():
+            if child != self.regions and child != self.flow:
+                child.removeNode()
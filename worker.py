@@ -0,0 +1,107 @@
+from __future__ import print_function
+import threading
+import traceback
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class JobCancelled(Exception):
+    """ Raised inside a job function (by the progress callback) once the job was cancelled """
+    pass
+
+
+class BackgroundJob:
+    """
+    Runs function(*args, progress=callback) on a worker thread, so the editor can still
+    render and paint while it runs. The function should only work on copies of the data
+    (numpy arrays, PNMImages), not on the scene graph.
+    The function calls progress(fraction) now and then, that raises JobCancelled if the job
+    was cancelled. The on_* callbacks are called from a task, so on the main thread:
+    on_progress(fraction), on_done(result), on_error(exception) and on_cancel() (right away,
+    from cancel()). After a cancel() the result of the function is thrown away, but the thread
+    only stops at the next progress() call: a job started with after=<the cancelled job> waits
+    for that thread to end before it runs, so two jobs never write the same files at once.
+    """
+
+    def __init__(self, name, function, args=(), on_done=None, on_progress=None, on_error=None, on_cancel=None,
+                 after=None):
+        self.name = name
+        self.progress = 0.0
+        self.running = True
+        self.cancelled = False
+        self.on_done = on_done
+        self.on_progress = on_progress
+        self.on_error = on_error
+        self.on_cancel = on_cancel
+        self._cancel_event = threading.Event()
+        self._messages = queue.Queue()
+        self._thread = threading.Thread(target=self._run, args=(function, args, after), name=name)
+        self._thread.daemon = True
+        self._thread.start()
+        self._task = taskMgr.add(self._poll, 'job_' + name)
+
+    def cancel(self):
+        if not self.running:
+            return
+        self.running = False
+        self.cancelled = True
+        self._cancel_event.set()
+        taskMgr.remove(self._task)
+        if self.on_cancel:
+            self.on_cancel()
+
+    def _report(self, fraction):
+        # called on the worker thread
+        if self._cancel_event.is_set():
+            raise JobCancelled(self.name)
+        self._messages.put(('progress', fraction))
+
+    def isAlive(self):
+        """ True until the worker thread ends, a cancelled job can still be running """
+        return self._thread.is_alive()
+
+    def join(self, timeout=None):
+        """ Waits for the worker thread to end """
+        self._thread.join(timeout)
+
+    def _run(self, function, args, after):
+        if after is not None:
+            after.join()
+        if self._cancel_event.is_set():
+            return
+        try:
+            result = function(*args, progress=self._report)
+        except JobCancelled:
+            return
+        except Exception as exception:
+            traceback.print_exc()
+            self._messages.put(('error', exception))
+            return
+        self._messages.put(('done', result))
+
+    def _poll(self, task):
+        fraction = None
+        while True:
+            try:
+                message, value = self._messages.get_nowait()
+            except queue.Empty:
+                break
+            if message == 'progress':
+                fraction = value
+                continue
+            self.running = False
+            if message == 'done':
+                self.progress = 1.0
+                if self.on_done:
+                    self.on_done(value)
+            elif self.on_error:
+                self.on_error(value)
+            return task.done
+        if fraction is not None:
+            self.progress = fraction
+            if self.on_progress:
+                self.on_progress(fraction)
+        return task.cont